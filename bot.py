@@ -1,422 +1,3026 @@
-""" Instagram Downloader Telegram Bot (all-in-one enhanced) Features included:
+"""
+Instagram Downloader Telegram Bot (all-in-one enhanced)
+
+Features included:
+- Download public Instagram posts/reels (single or batch URLs)
+- Persistent per-chat settings (mode: media/document, caption on/off, link passthrough)
+- Passthrough mode: Telegram fetches media from Instagram's CDN itself (no bytes via this host)
+- Persistent stats (downloads count, bytes sent, last activity)
+- Rate limiting per-chat (excess batches are queued with an ETA)
+- Outbound send scheduler honouring Telegram flood limits and retry_after
+- Auto-cleaner background thread to remove temp dirs older than TEMP_MAX_AGE_MIN
+  and keep them under TEMP_QUOTA_MB
+- Thumbnail collage generation for multi-photo posts (Pillow)
+- Hashtag extractor from captions
+- /settings UI with inline buttons
+- /stats command (plus a runtime digest for OWNER_ID)
+- Per-stage latency histograms and counters on a Prometheus endpoint (METRICS_PORT)
 
-Download public Instagram posts/reels (single or batch URLs)
+Dependencies:
+- instaloader
+- pytelegrambotapi
+- pillow
+- aiohttp (optional, for BOT_ENGINE=async)
+
+Install:
+    pip install instaloader pytelegrambotapi pillow
+
+Run:
+    export BOT_TOKEN=<telegram-bot-token>
+    # optional for private posts you follow
+    # export IG_USER=your_ig_user
+    # export IG_PASS=your_ig_pass
+    # asyncio engine (AsyncTeleBot + aiohttp) instead of worker threads
+    # export BOT_ENGINE=async
+    python instagram_downloader_bot_full.py
+
+Note: Use responsibly. Only download/share content you have rights to.
+Instagram scraping may be restricted by Instagram's Terms.
+"""
+
+import io
+import os
+import re
+import sys
+import time
+import json
+import html
+import hmac
+import shutil
+import heapq
+import bisect
+import tempfile
+import sqlite3
+import signal
+import atexit
+import threading
+import multiprocessing
+import asyncio
+import contextvars
+from contextlib import contextmanager, ExitStack
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from collections import OrderedDict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Tuple, Dict, Any
+from datetime import datetime, timedelta
+
+import requests
+import instaloader
+from instaloader import Post, InstaloaderContext
+import telebot
+from telebot.types import (InlineKeyboardMarkup, InlineKeyboardButton,
+                           InputMediaPhoto, InputMediaVideo, InputMediaDocument)
+
+try:  # optional: only needed for BOT_ENGINE=async
+    import aiohttp
+    from telebot import asyncio_helper
+    from telebot.async_telebot import AsyncTeleBot
+except ImportError:
+    aiohttp = None
+
+from collage import render_collage
+
+# -------------------- Configuration --------------------
+
+BOT_TOKEN = os.getenv("BOT_TOKEN")
+if not BOT_TOKEN:
+    raise SystemExit("Please export BOT_TOKEN=<your_telegram_bot_token>")
+
+DATA_DIR = os.getenv("DATA_DIR", "./data")
+os.makedirs(DATA_DIR, exist_ok=True)
+
+SETTINGS_FILE = os.path.join(DATA_DIR, "settings.json")  # legacy, migrated into DB_FILE
+STATS_FILE = os.path.join(DATA_DIR, "stats.json")  # legacy, migrated into DB_FILE
+DB_FILE = os.path.join(DATA_DIR, "bot.db")
+STORE_FLUSH_SEC = float(os.getenv("STORE_FLUSH_SEC", "5"))  # stats write-behind interval
+FILE_CACHE_FILE = os.path.join(DATA_DIR, "file_ids.json")  # legacy, migrated into DB_FILE
+FILE_CACHE_MAX_ENTRIES = int(os.getenv("FILE_CACHE_MAX_ENTRIES", "5000"))
+FILE_CACHE_TTL_HOURS = float(os.getenv("FILE_CACHE_TTL_HOURS", "72"))
+TEMP_DIR = os.getenv("TEMP_DIR", None) or tempfile.gettempdir()
+TEMP_PREFIX = os.getenv("TEMP_PREFIX", "ig_dl_")
+TEMP_MAX_AGE_MIN = int(os.getenv("TEMP_MAX_AGE_MIN", "30"))  # cleanup age
+TEMP_QUOTA_MB = int(os.getenv("TEMP_QUOTA_MB", "2048"))  # max bytes our temp files may occupy
+RATE_LIMIT_PER_MIN = int(os.getenv("RATE_LIMIT_PER_MIN", "5"))  # batches a chat may start per minute
+RATE_QUEUE_MAX_SEC = float(os.getenv("RATE_QUEUE_MAX_SEC", "300"))  # queue beyond that, refuse past this wait
+SEND_GLOBAL_PER_SEC = float(os.getenv("SEND_GLOBAL_PER_SEC", "30"))  # Telegram: ~30 messages/s per bot
+SEND_PRIVATE_PER_SEC = float(os.getenv("SEND_PRIVATE_PER_SEC", "1"))  # Telegram: ~1 message/s per chat
+SEND_PRIVATE_BURST = int(os.getenv("SEND_PRIVATE_BURST", "10"))
+SEND_GROUP_PER_MIN = float(os.getenv("SEND_GROUP_PER_MIN", "20"))  # Telegram: ~20 messages/min per group
+SEND_MAX_RETRIES = int(os.getenv("SEND_MAX_RETRIES", "3"))  # 429 retries per request
+TELEGRAM_ALBUM_MAX = 10
+TELEGRAM_URL_PHOTO_MAX = 5 * 1024 * 1024  # largest photo Telegram will fetch from a URL
+TELEGRAM_URL_FILE_MAX = 20 * 1024 * 1024  # largest other file Telegram will fetch from a URL
+BOT_THREADS = int(os.getenv("BOT_THREADS", "2"))  # concurrent update handlers (upload stage)
+DOWNLOAD_WORKERS = int(os.getenv("DOWNLOAD_WORKERS", "3"))  # shared download/collage stage
+PIPELINE_PREFETCH = int(os.getenv("PIPELINE_PREFETCH", "3"))  # links downloaded ahead per batch
+SPOOL_MAX_MEMORY = int(float(os.getenv("SPOOL_MAX_MEMORY_MB", "8")) * 1024 * 1024)  # per file, then spill to TEMP_DIR
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "60"))
+COLLAGE_WORKERS = int(os.getenv("COLLAGE_WORKERS", "1"))  # 0 = render in the download thread
+COLLAGE_CACHE_MAX = int(os.getenv("COLLAGE_CACHE_MAX", "128"))  # rendered collages kept in memory
+OWNER_ID = os.getenv("OWNER_ID")  # optional: for admin features
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")  # e.g. http://127.0.0.1:8081/bot{0}/{1} (local/fake Bot API)
+
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()  # polling | webhook
+BOT_ENGINE = os.getenv("BOT_ENGINE", "threads").lower()  # threads | async (AsyncTeleBot + aiohttp, polling only)
+ASYNC_HTTP_LIMIT = int(os.getenv("ASYNC_HTTP_LIMIT", "100"))  # pooled connections per aiohttp session
+ASYNC_DOWNLOADS = int(os.getenv("ASYNC_DOWNLOADS", "32"))  # posts downloading at once (async engine)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # public base URL; setWebhook is called when set
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")  # required in webhook mode: Telegram echoes it on every POST
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "8"))
+WEBHOOK_QUEUE_MAX = int(os.getenv("WEBHOOK_QUEUE_MAX", "1000"))
+WEBHOOK_ENQUEUE_TIMEOUT = float(os.getenv("WEBHOOK_ENQUEUE_TIMEOUT", "2"))  # then 503 so Telegram retries
+WEBHOOK_DRAIN_TIMEOUT = float(os.getenv("WEBHOOK_DRAIN_TIMEOUT", "30"))  # also bounds the async engine's shutdown drain
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # Prometheus /metrics endpoint; 0 = off
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1")
+
+IG_USER = os.getenv("IG_USER")
+IG_PASS = os.getenv("IG_PASS")
+IG_POOL_SIZE = int(os.getenv("IG_POOL_SIZE", "2"))  # concurrent Instaloader sessions
+IG_POOL_TIMEOUT = float(os.getenv("IG_POOL_TIMEOUT", "60"))  # max wait for a free session
+IG_BACKOFF_BASE = float(os.getenv("IG_BACKOFF_BASE", "60"))  # first cooldown after 401/429
+IG_BACKOFF_MAX = float(os.getenv("IG_BACKOFF_MAX", "1800"))
+IG_SESSION_FILE = os.path.join(DATA_DIR, f"ig_session_{IG_USER}") if IG_USER else None
+
+# -------------------- Metrics --------------------
+# Per-stage latency histograms, counters and gauges kept in process. Stages:
+# resolve (Post.from_shortcode), download (CDN fetch), collage, upload,
+# persist (SQLite flush) and request (one whole message/batch); failures
+# outside any stage count under "pipeline". Served in Prometheus text format
+# on METRICS_PORT and summarised for OWNER_ID in /stats.
+
+class Metrics:
+    BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+    HELP = {
+        'ig_stage_seconds': ('histogram', 'Time spent per pipeline stage'),
+        'ig_errors_total': ('counter', 'Exceptions raised per stage and type'),
+        'ig_inflight': ('gauge', 'Stage executions currently running'),
+        'ig_queue_depth': ('gauge', 'Work items waiting to start'),
+        'ig_urls_total': ('counter', 'Links processed by result'),
+        'ig_items_sent_total': ('counter', 'Media items delivered'),
+        'ig_bytes_sent_total': ('counter', 'Bytes delivered'),
+        'ig_bytes_saved_total': ('counter', 'Bytes Telegram fetched from the CDN itself (passthrough)'),
+        'ig_rate_limited_total': ('counter', 'Messages rejected by the per-chat rate limit'),
+        'ig_coalesced_total': ('counter', 'Links that joined a download already in flight'),
+        'ig_flood_waits_total': ('counter', 'Bot API calls answered 429 and retried'),
+        'ig_queued_total': ('counter', 'Batches delayed by the per-chat rate limit instead of refused'),
+        'ig_uptime_seconds': ('gauge', 'Seconds since start'),
+        'ig_session_cooldown_seconds': ('gauge', 'Seconds until an Instagram session is back in rotation'),
+    }
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.hist: Dict[str, Dict[str, Any]] = {}  # stage -> {'buckets', 'sum', 'count'}
+        self.counters: Dict[Tuple[str, tuple], float] = {}
+        self.inflight: Dict[str, int] = {}
+        self.gauges: Dict[Tuple[str, tuple], Any] = {}  # (name, labels) -> callable
+
+    def observe(self, stage: str, seconds: float):
+        with self.lock:
+            h = self.hist.get(stage)
+            if h is None:
+                h = self.hist[stage] = {'buckets': [0] * (len(self.BUCKETS) + 1), 'sum': 0.0, 'count': 0}
+            h['buckets'][bisect.bisect_left(self.BUCKETS, seconds)] += 1
+            h['sum'] += seconds
+            h['count'] += 1
+
+    def inc(self, name: str, amount: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def error(self, stage: str, error: BaseException):
+        """Count an exception once, under the innermost stage that saw it."""
+        if getattr(error, '_metrics_counted', False):
+            return
+        try:
+            error._metrics_counted = True
+        except Exception:
+            pass
+        self.inc('ig_errors_total', stage=stage, type=type(error).__name__)
+
+    def gauge(self, name: str, fn, **labels):
+        """Register a callable sampled at scrape time."""
+        with self.lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = fn
+
+    @contextmanager
+    def stage(self, stage: str):
+        """Time the block into ig_stage_seconds and count any exception it raises."""
+        with self.lock:
+            self.inflight[stage] = self.inflight.get(stage, 0) + 1
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            self.error(stage, e)
+            raise
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+            with self.lock:
+                self.inflight[stage] -= 1
+
+    def quantile(self, stage: str, q: float) -> float | None:
+        """Estimate a quantile from the bucket counts (linear within a bucket)."""
+        with self.lock:
+            h = self.hist.get(stage)
+            if not h or not h['count']:
+                return None
+            buckets = list(h['buckets'])
+            count = h['count']
+        rank = q * count
+        seen = 0
+        lower = 0.0
+        for i, n in enumerate(buckets[:-1]):
+            upper = self.BUCKETS[i]
+            if n and seen + n >= rank:
+                return lower + (upper - lower) * (rank - seen) / n
+            seen += n
+            lower = upper
+        return self.BUCKETS[-1]
+
+    def _sample_gauges(self) -> List[Tuple[str, tuple, float]]:
+        with self.lock:
+            gauges = list(self.gauges.items())
+            out = [('ig_inflight', (('stage', k),), v) for k, v in self.inflight.items()]
+        out.append(('ig_uptime_seconds', (), time.time() - self.started))
+        for (name, labels), fn in gauges:
+            try:
+                out.append((name, labels, float(fn())))
+            except Exception:
+                pass
+        return out
+
+    @staticmethod
+    def _labels(labels: tuple, **extra) -> str:
+        pairs = list(labels) + list(extra.items())
+        if not pairs:
+            return ''
+        escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+        return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+    def render(self) -> str:
+        """Prometheus text exposition format (0.0.4)."""
+        series: Dict[str, List[str]] = {}
+        with self.lock:
+            hist = {k: (list(v['buckets']), v['sum'], v['count']) for k, v in self.hist.items()}
+            counters = list(self.counters.items())
+        for stage, (buckets, total, count) in sorted(hist.items()):
+            lines = series.setdefault('ig_stage_seconds', [])
+            cumulative = 0
+            for bound, n in zip(self.BUCKETS, buckets):
+                cumulative += n
+                lines.append(f'ig_stage_seconds_bucket{self._labels((("stage", stage),), le=bound)} {cumulative}')
+            lines.append(f'ig_stage_seconds_bucket{self._labels((("stage", stage),), le="+Inf")} {count}')
+            lines.append(f'ig_stage_seconds_sum{self._labels((("stage", stage),))} {total}')
+            lines.append(f'ig_stage_seconds_count{self._labels((("stage", stage),))} {count}')
+        for (name, labels), value in sorted(counters):
+            series.setdefault(name, []).append(f'{name}{self._labels(labels)} {value}')
+        for name, labels, value in self._sample_gauges():
+            series.setdefault(name, []).append(f'{name}{self._labels(labels)} {value}')
+        out = []
+        for name, lines in series.items():
+            kind, help_text = self.HELP.get(name, ('untyped', name))
+            out.append(f'# HELP {name} {help_text}')
+            out.append(f'# TYPE {name} {kind}')
+            out.extend(lines)
+        return '\n'.join(out) + '\n'
+
+    def summary(self) -> str:
+        """Short HTML digest for the owner's /stats."""
+        up = int(time.time() - self.started)
+        lines = [f"🛠 Runtime (up {up // 3600}h {up % 3600 // 60}m)"]
+        with self.lock:
+            stages = {k: v['count'] for k, v in self.hist.items()}
+            counters = dict(self.counters)
+        for stage in ('request', 'resolve', 'download', 'collage', 'upload', 'persist'):
+            if stages.get(stage):
+                lines.append(f"• {stage}: {stages[stage]}× p50 {self.quantile(stage, 0.5):.2f}s · "
+                             f"p95 {self.quantile(stage, 0.95):.2f}s · p99 {self.quantile(stage, 0.99):.2f}s")
+        urls = {dict(labels).get('result'): int(v) for (name, labels), v in counters.items() if name == 'ig_urls_total'}
+        if urls:
+            coalesced = int(counters.get(('ig_coalesced_total', ()), 0))
+            lines.append("• Links: " + ", ".join(f"{n} {r}" for r, n in sorted(urls.items()))
+                         + (f" ({coalesced} shared a download)" if coalesced else ""))
+        sent = counters.get(('ig_bytes_sent_total', ()), 0)
+        if sent:
+            lines.append(f"• Throughput: {round(sent / (1024 * 1024) / max(up, 1) * 3600, 2)} MB/h")
+        saved = counters.get(('ig_bytes_saved_total', ()), 0)
+        if saved:
+            lines.append(f"• Passthrough saved: {round(saved / (1024 * 1024), 2)} MB")
+        gauges = self._sample_gauges()
+        queues = [f"{dict(l).get('queue')} {int(v)}" for n, l, v in gauges if n == 'ig_queue_depth']
+        busy = [f"{dict(l).get('stage')} {int(v)}" for n, l, v in gauges if n == 'ig_inflight' and v]
+        if queues:
+            lines.append("• Queued: " + ", ".join(queues))
+        lines.append("• In flight: " + (", ".join(busy) or "none"))
+        errors = sorted(((v, dict(l)) for (n, l), v in counters.items() if n == 'ig_errors_total'),
+                        key=lambda x: -x[0])
+        if errors:
+            lines.append("• Errors: " + ", ".join(
+                f"{html.escape(l['type'])}@{l['stage']} {int(v)}" for v, l in errors[:5]))
+        return "\n".join(lines)
+
+
+METRICS = Metrics()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = METRICS.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
 
-Persistent per-chat settings (mode: media/document, caption on/off)
 
-Persistent stats (downloads count, bytes sent, last activity)
+def start_metrics_server():
+    if not METRICS_PORT:
+        return
+    server = ThreadingHTTPServer((METRICS_LISTEN, METRICS_PORT), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    print(f'Metrics on http://{METRICS_LISTEN}:{server.server_port}/metrics')
+
+
+# -------------------- Utilities & Stores --------------------
+
+
+
+def start_collage_pool() -> ProcessPoolExecutor | None:
+    """Fork the collage workers up front; a fork pool spawns them all on its first submit."""
+    if COLLAGE_WORKERS <= 0:
+        return None
+    pool = ProcessPoolExecutor(max_workers=COLLAGE_WORKERS, mp_context=multiprocessing.get_context('fork'))
+    pool.submit(int).result()
+    return pool
+
+
+# Collage rendering runs in worker processes so decoding doesn't hold the GIL
+# against the download/upload threads. They must be forked before the first
+# thread starts (TeleBot's worker pool, just below); spawn/forkserver workers
+# would re-run this whole script as __mp_main__. They only run collage.py code.
+COLLAGE_POOL = start_collage_pool()
+
+if TELEGRAM_API_URL:
+    telebot.apihelper.API_URL = TELEGRAM_API_URL
+bot = telebot.TeleBot(BOT_TOKEN, parse_mode="HTML", num_threads=BOT_THREADS)
+
+URL_RE = re.compile(r"(https?://(?:www\.)?instagram\.com/(?:p|reel|tv)/[A-Za-z0-9_-]+)", re.IGNORECASE)
+SHORT_REDIR_RE = re.compile(r"(https?://(?:www\.)?(?:instagr\.am|instagram\.com)/(?:p|reel|tv)/[A-Za-z0-9_-]+)", re.IGNORECASE)
+
+
+# Thread-safe key/value store (SQLite, WAL) with an in-memory read cache
+class SQLiteStore:
+    """Drop-in for the old JSONStore: get/set/update_subkey/inc on top-level keys.
+
+    All rows of a namespace are held in memory; reads never touch disk.
+    Mutations mark the key dirty and flush() writes only dirty rows in one
+    transaction, so a download costs O(1) row writes instead of rewriting
+    the whole file. With write_through=False (stats), dirty keys are
+    coalesced and flushed every STORE_FLUSH_SEC and at exit; with
+    write_through=True (settings), set/update_subkey flush immediately.
+    On first start the legacy JSON file is imported and renamed *.migrated.
+    """
+
+    def __init__(self, db_path: str, namespace: str, legacy_json: str = None, write_through: bool = False):
+        self.namespace = namespace
+        self.write_through = write_through
+        self.lock = threading.RLock()
+        self.db_lock = threading.Lock()
+        self.data: Dict[str, Any] = {}
+        self.dirty: set = set()
+        self.db = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS kv (ns TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, PRIMARY KEY (ns, key))")
+        self._load()
+        if not self.data and legacy_json:
+            self._migrate(legacy_json)
+
+    def _load(self):
+        for key, value in self.db.execute("SELECT key, value FROM kv WHERE ns = ?", (self.namespace,)):
+            try:
+                self.data[key] = json.loads(value)
+            except Exception:
+                pass
 
-Rate limiting per-chat
+    def _migrate(self, path: str):
+        if not os.path.isfile(path):
+            return
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                legacy = json.load(f)
+        except Exception:
+            return
+        with self.lock:
+            self.data.update({str(k): v for k, v in legacy.items()})
+            self.dirty.update(self.data)
+        self.flush()
+        try:
+            os.replace(path, path + ".migrated")
+        except Exception:
+            pass
 
-Auto-cleaner background thread to remove temp dirs older than TEMP_MAX_AGE_MIN
+    def flush(self):
+        error = None
+        # db_lock before the snapshot, so concurrent flushes commit snapshots in the order they were taken
+        with self.db_lock:
+            with self.lock:
+                if not self.dirty:
+                    return
+                rows = []
+                deleted = []
+                for k in self.dirty:
+                    if k in self.data:
+                        rows.append((self.namespace, k, json.dumps(self.data[k], ensure_ascii=False, default=str)))
+                    else:
+                        deleted.append((self.namespace, k))
+                self.dirty.clear()
+            try:
+                with METRICS.stage('persist'):
+                    self.db.execute("BEGIN")
+                    self.db.executemany("INSERT OR REPLACE INTO kv (ns, key, value) VALUES (?, ?, ?)", rows)
+                    self.db.executemany("DELETE FROM kv WHERE ns = ? AND key = ?", deleted)
+                    self.db.execute("COMMIT")
+            except Exception as e:
+                error = e
+                try:
+                    self.db.execute("ROLLBACK")
+                except Exception:
+                    pass
+                with self.lock:
+                    # retry on the next flush
+                    self.dirty.update(k for _, k, _ in rows)
+                    self.dirty.update(k for _, k in deleted)
+        if error is not None:
+            raise error
+
+    def _write_through(self):
+        # called after self.lock is released: flush() takes db_lock first
+        if self.write_through:
+            self.flush()
+
+    def get(self, key, default=None):
+        with self.lock:
+            return self.data.get(str(key), default)
+
+    def set(self, key, value):
+        with self.lock:
+            self.data[str(key)] = value
+            self.dirty.add(str(key))
+        self._write_through()
+
+    def update_subkey(self, key, subkey, value):
+        with self.lock:
+            k = str(key)
+            if k not in self.data:
+                self.data[k] = {}
+            self.data[k][subkey] = value
+            self.dirty.add(k)
+        self._write_through()
+
+    def inc(self, key, subkey, amount=1):
+        with self.lock:
+            k = str(key)
+            if k not in self.data:
+                self.data[k] = {}
+            self.data[k][subkey] = self.data[k].get(subkey, 0) + amount
+            self.dirty.add(k)
+
+    def delete(self, key):
+        with self.lock:
+            k = str(key)
+            if self.data.pop(k, None) is None:
+                return
+            self.dirty.add(k)
+        self._write_through()
+
+
+PREFS = SQLiteStore(DB_FILE, "settings", legacy_json=SETTINGS_FILE, write_through=True)
+STATS = SQLiteStore(DB_FILE, "stats", legacy_json=STATS_FILE)
+FILE_IDS = SQLiteStore(DB_FILE, "file_ids", legacy_json=FILE_CACHE_FILE)  # rows behind FILE_CACHE
+
+
+def store_flusher_worker():
+    while True:
+        time.sleep(STORE_FLUSH_SEC)
+        for store in (PREFS, STATS, FILE_IDS):
+            try:
+                store.flush()
+            except Exception:
+                pass
 
-Thumbnail collage generation for multi-photo posts (Pillow)
 
-Hashtag extractor from captions
+def flush_stores():
+    for store in (PREFS, STATS, FILE_IDS):
+        try:
+            store.flush()
+        except Exception:
+            pass
 
-/settings UI with inline buttons
 
-/stats command
+store_flusher_thread = threading.Thread(target=store_flusher_worker, daemon=True)
+store_flusher_thread.start()
+atexit.register(flush_stores)
+
+
+# Telegram file_id cache: shortcode + send mode -> what we already uploaded
+class FileIdCache:
+    """Persistent LRU of Telegram file_ids keyed by "<shortcode>:<mode>".
+
+    Each entry holds the sent items ({kind, file_id, cap}), the post meta,
+    the rendered caption and the original byte size. Entries older than
+    max_age seconds or beyond max_entries (least recently used first) are
+    evicted. Entries are rows of a SQLiteStore, so a change writes only that
+    row on the next store flush.
+    """
+
+    def __init__(self, store: SQLiteStore, max_entries: int, max_age: float):
+        self.store = store
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        with store.lock:
+            # LRU order survives restarts through each entry's 'used' time
+            self.data: "OrderedDict[str, dict]" = OrderedDict(
+                sorted(store.data.items(), key=lambda kv: kv[1].get('used', 0)))
+
+    @staticmethod
+    def key(shortcode: str, mode: str) -> str:
+        return f"{shortcode}:{mode}"
+
+    def _drop(self, k: str):
+        del self.data[k]
+        self.store.delete(k)
+
+    def _evict(self, now: float):
+        cutoff = now - self.max_age
+        for k in [k for k, v in self.data.items() if v.get('ts', 0) < cutoff]:
+            self._drop(k)
+        while len(self.data) > self.max_entries:
+            self._drop(next(iter(self.data)))
+
+    def get(self, shortcode: str, mode: str, count: bool = True) -> dict | None:
+        """Look an entry up; count=False for re-checks that must not skew the hit rate."""
+        k = self.key(shortcode, mode)
+        now = time.time()
+        with self.lock:
+            entry = self.data.get(k)
+            if entry is None or entry.get('ts', 0) < now - self.max_age:
+                if entry is not None:
+                    self._drop(k)
+                self.misses += count
+                return None
+            entry['used'] = now
+            self.data.move_to_end(k)
+            self.store.set(k, entry)
+            self.hits += count
+            return entry
+
+    def put(self, shortcode: str, mode: str, items: List[dict], meta: dict, caption: str, size: int):
+        if not items or any(not it.get('file_id') for it in items):
+            return  # partial upload, nothing reusable
+        now = time.time()
+        with self.lock:
+            k = self.key(shortcode, mode)
+            self.data[k] = {
+                'items': items,
+                'meta': meta,
+                'caption': caption,
+                'bytes': size,
+                'ts': now,
+                'used': now,
+            }
+            self.data.move_to_end(k)
+            self.store.set(k, self.data[k])
+            self._evict(now)
+
+    def invalidate(self, shortcode: str, mode: str):
+        with self.lock:
+            k = self.key(shortcode, mode)
+            if k in self.data:
+                self._drop(k)
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'entries': len(self.data),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': (self.hits / total) if total else 0.0,
+            }
+
+
+FILE_CACHE = FileIdCache(FILE_IDS, FILE_CACHE_MAX_ENTRIES, FILE_CACHE_TTL_HOURS * 3600)
+
+# Per-chat request admission. Each chat may start RATE_LIMIT_PER_MIN batches
+# per minute in a burst; beyond that a batch is queued (GCRA: one slot every
+# 60/RATE_LIMIT_PER_MIN s) rather than refused, up to RATE_QUEUE_MAX_SEC out.
+RATE_TAT: Dict[int, float] = {}  # chat_id -> theoretical arrival time of the next slot
+TOKENS_LOCK = threading.Lock()
+
+
+def rate_reserve(chat_id: int) -> float | None:
+    """Reserve a batch slot. Returns seconds to wait before starting, or None if the queue is too long."""
+    now = time.monotonic()
+    interval = 60.0 / max(1, RATE_LIMIT_PER_MIN)
+    burst = 60.0 - interval
+    with TOKENS_LOCK:
+        tat = max(RATE_TAT.get(chat_id, now), now)
+        delay = max(0.0, tat - burst - now)
+        if delay > RATE_QUEUE_MAX_SEC:
+            return None
+        RATE_TAT[chat_id] = tat + interval
+        if len(RATE_TAT) > 10000:
+            for k in [k for k, v in RATE_TAT.items() if v <= now]:
+                del RATE_TAT[k]
+        return delay
+
+
+# -------------------- Outbound send scheduler --------------------
+# Every Bot API request goes through telebot's CUSTOM_REQUEST_SENDER hook.
+# Message-producing methods (send*/edit*/copy*/forward*) first take a slot
+# from SEND: a global budget plus a per-chat one (private chats ~1/s with
+# short bursts, groups ~20 messages/min). Waiters are served interactive
+# first, then oldest first. A 429 pauses that chat for retry_after and the
+# request is retried instead of failing the batch.
+
+class _Bucket:
+    __slots__ = ('rate', 'burst', 'tokens', 'last', 'blocked_until')
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = now
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def delay(self, cost: float, now: float) -> float:
+        self._refill(now)
+        wait = max(0.0, self.blocked_until - now)
+        if self.tokens < cost:
+            wait = max(wait, (cost - self.tokens) / self.rate)
+        return wait
+
+    def take(self, cost: float, now: float):
+        self._refill(now)
+        self.tokens -= cost
+
+
+class _SendWaiter:
+    __slots__ = ('chat', 'cost', 'event', 'loop', 'fut', 'granted', 'cancelled')
+
+    def __init__(self, chat: str | None, cost: int, loop=None):
+        self.chat = chat
+        self.cost = cost
+        self.loop = loop
+        self.event = None if loop else threading.Event()
+        self.fut = loop.create_future() if loop else None
+        self.granted = False
+        self.cancelled = False
+
+    def grant(self):
+        self.granted = True
+        if self.loop is None:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(self._resolve)
+
+    def _resolve(self):
+        if not self.fut.done():
+            self.fut.set_result(None)
+
+
+class SendScheduler:
+    """Global + per-chat token buckets with a priority wait list.
+
+    acquire() blocks the calling thread until its request may go out; the
+    request itself still runs on that thread, so uploads stay parallel.
+    Threads inside priority(SendScheduler.BULK) yield to interactive ones.
+
+    Waiters queue per chat by (priority, seq). Each chat with waiters has one
+    slot: in `ready` (keyed by its best waiter) while its bucket has room, in
+    `timers` (keyed by when it will) otherwise. _pump() grants from `ready`
+    while the global bucket allows and wakes only the waiters it grants; a
+    "send-scheduler" thread runs it again when the next timer falls due.
+    """
+
+    INTERACTIVE = 0
+    BULK = 1
+
+    def __init__(self, global_per_sec: float, private_per_sec: float, private_burst: int, group_per_min: float):
+        self.cond = threading.Condition()
+        self.global_bucket = _Bucket(global_per_sec, global_per_sec, time.monotonic())
+        self.private = (private_per_sec, private_burst)
+        self.group = (group_per_min / 60.0, group_per_min)
+        self.chats: Dict[str, _Bucket] = {}
+        self.queues: Dict[str | None, List[tuple]] = {}  # chat -> heap of (priority, seq, waiter)
+        self.slot: Dict[str | None, int] = {}  # chat -> token of its live ready/timers entry
+        self.ready: List[tuple] = []  # (priority, seq, token, chat)
+        self.timers: List[tuple] = []  # (due, token, chat)
+        self.waiting = 0
+        self.seq = 0
+        self.wake_at: float | None = None
+        # a ContextVar rather than thread-local so asyncio tasks each keep their own
+        self.level = contextvars.ContextVar('send_priority', default=self.INTERACTIVE)
+        threading.Thread(target=self._run, name="send-scheduler", daemon=True).start()
+
+    @contextmanager
+    def priority(self, level: int):
+        token = self.level.set(level)
+        try:
+            yield
+        finally:
+            self.level.reset(token)
+
+    def _chat(self, chat: str, now: float) -> _Bucket:
+        b = self.chats.get(chat)
+        if b is None:
+            if len(self.chats) > 10000:
+                # idle buckets are full again and carry no state
+                for k in [k for k, v in self.chats.items() if v.delay(v.burst, now) <= 0]:
+                    del self.chats[k]
+            rate, burst = self.group if chat.startswith('-') else self.private
+            b = self.chats[chat] = _Bucket(rate, burst, now)
+        return b
+
+    def _cost(self, chat: str | None, cost: int) -> float:
+        # group limits count messages (an album is several); private chats count requests
+        if chat is None or not chat.startswith('-'):
+            return 1
+        return min(cost, self.group[1])
+
+    def _chat_delay(self, chat: str | None, cost: int, now: float) -> float:
+        return 0.0 if chat is None else self._chat(chat, now).delay(self._cost(chat, cost), now)
+
+    def _delay(self, chat: str | None, cost: int, now: float) -> float:
+        return max(self.global_bucket.delay(1, now), self._chat_delay(chat, cost, now))
+
+    def _schedule(self, chat: str | None, now: float):
+        """(Re)place chat's slot for its current best waiter; stale entries are skipped when popped."""
+        q = self.queues.get(chat)
+        while q and q[0][2].cancelled:
+            heapq.heappop(q)
+        if not q:
+            self.queues.pop(chat, None)
+            self.slot.pop(chat, None)
+            return
+        self.seq += 1
+        token = self.slot[chat] = self.seq
+        priority, seq, w = q[0]
+        wait = self._chat_delay(chat, w.cost, now)
+        if wait > 0:
+            heapq.heappush(self.timers, (now + wait, token, chat))
+        else:
+            heapq.heappush(self.ready, (priority, seq, token, chat))
+
+    def _pump(self, now: float) -> float | None:
+        """Grant every waiter that may go now, best first. Returns when to pump next (None: idle)."""
+        while self.timers and self.timers[0][0] <= now:
+            _, token, chat = heapq.heappop(self.timers)
+            if self.slot.get(chat) == token:
+                self._schedule(chat, now)
+        while self.ready:
+            priority, seq, token, chat = self.ready[0]
+            if self.slot.get(chat) != token:
+                heapq.heappop(self.ready)
+                continue
+            wait = self.global_bucket.delay(1, now)
+            if wait > 0:
+                return now + wait if not self.timers else min(now + wait, self.timers[0][0])
+            heapq.heappop(self.ready)
+            q = self.queues[chat]
+            w = q[0][2]
+            if w.cancelled or q[0][:2] != (priority, seq) or self._chat_delay(chat, w.cost, now) > 0:
+                self._schedule(chat, now)  # a 429 backoff or a newer best waiter since it was queued
+                continue
+            heapq.heappop(q)
+            self.global_bucket.take(1, now)
+            if chat is not None:
+                self._chat(chat, now).take(self._cost(chat, w.cost), now)
+            self.waiting -= 1
+            w.grant()
+            self._schedule(chat, now)
+        return self.timers[0][0] if self.timers else None
+
+    def _kick(self, now: float):
+        nxt = self._pump(now)
+        if nxt is not None and (self.wake_at is None or nxt < self.wake_at):
+            self.cond.notify()
+
+    def _run(self):
+        with self.cond:
+            while True:
+                self.wake_at = self._pump(time.monotonic())
+                self.cond.wait(None if self.wake_at is None else max(0.0, self.wake_at - time.monotonic()))
+
+    def _enter(self, chat_id, cost: int, loop=None) -> _SendWaiter:
+        w = _SendWaiter(str(chat_id) if chat_id is not None else None, cost, loop)
+        with self.cond:
+            self.seq += 1
+            q = self.queues.setdefault(w.chat, [])
+            heapq.heappush(q, (self.level.get(), self.seq, w))
+            self.waiting += 1
+            now = time.monotonic()
+            if q[0][2] is w:
+                self._schedule(w.chat, now)
+            self._kick(now)
+        return w
+
+    def acquire(self, chat_id, cost: int = 1) -> float:
+        """Block until a request to chat_id may be sent. Returns seconds waited."""
+        start = time.monotonic()
+        w = self._enter(chat_id, cost)
+        if not w.granted:
+            w.event.wait()
+        return time.monotonic() - start
+
+    async def acquire_async(self, chat_id, cost: int = 1) -> float:
+        """acquire() for the asyncio engine: awaits a future instead of blocking a thread."""
+        start = time.monotonic()
+        w = self._enter(chat_id, cost, asyncio.get_running_loop())
+        if not w.granted:
+            try:
+                await w.fut
+            except asyncio.CancelledError:
+                with self.cond:
+                    if not w.granted:
+                        w.cancelled = True
+                        self.waiting -= 1
+                        self._schedule(w.chat, time.monotonic())
+                raise
+        return time.monotonic() - start
+
+    def backoff(self, chat_id, retry_after: float):
+        """Telegram answered 429: hold this chat (or everything, if chat_id is None)."""
+        with self.cond:
+            now = time.monotonic()
+            b = self._chat(str(chat_id), now) if chat_id is not None else self.global_bucket
+            b.blocked_until = max(b.blocked_until, now + retry_after)
+            self._kick(now)
+
+    def eta(self, chat_id) -> float:
+        """Rough seconds until a new request to chat_id would go out."""
+        chat = str(chat_id)
+        with self.cond:
+            now = time.monotonic()
+            ahead = len(self.queues.get(chat, ()))
+            b = self._chat(chat, now)
+            return self._delay(chat, 1, now) + ahead / b.rate
+
+    def depth(self) -> int:
+        with self.cond:
+            return self.waiting
+
+
+SEND = SendScheduler(SEND_GLOBAL_PER_SEC, SEND_PRIVATE_PER_SEC, SEND_PRIVATE_BURST, SEND_GROUP_PER_MIN)
+SEND_METHOD_PREFIXES = ('send', 'edit', 'copy', 'forward')
+
+TG_HTTP = requests.Session()
+TG_HTTP.mount('https://', requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=max(8, BOT_THREADS + WEBHOOK_WORKERS)))
+TG_HTTP.mount('http://', requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=max(8, BOT_THREADS + WEBHOOK_WORKERS)))
+
+
+def _rewind(files: Dict[str, Any] | None):
+    for value in (files or {}).values():
+        fh = value[1] if isinstance(value, tuple) else value
+        if hasattr(fh, 'seek'):
+            fh.seek(0)
+
+
+def _send_cost(api_method: str, params: Dict[str, Any] | None) -> int:
+    """Messages a call produces: the item count for an album, else 1."""
+    if api_method == 'sendMediaGroup':
+        try:
+            return len(json.loads(params['media']))
+        except Exception:
+            pass
+    return 1
+
+
+def _send_request(method, url, params=None, files=None, **kwargs):
+    """telebot CUSTOM_REQUEST_SENDER: schedule message-producing calls and retry 429s."""
+    api_method = url.rsplit('/', 1)[-1]
+    throttled = api_method.startswith(SEND_METHOD_PREFIXES)
+    chat_id = (params or {}).get('chat_id')
+    cost = _send_cost(api_method, params)
+    for attempt in range(SEND_MAX_RETRIES + 1):
+        if throttled:
+            METRICS.observe('send_wait', SEND.acquire(chat_id, cost))
+        if attempt:
+            _rewind(files)
+        resp = TG_HTTP.request(method, url, params=params, files=files, **kwargs)
+        if resp.status_code != 429 or attempt == SEND_MAX_RETRIES:
+            return resp
+        try:
+            retry_after = float(resp.json()['parameters']['retry_after'])
+        except Exception:
+            retry_after = 1.0
+        METRICS.inc('ig_flood_waits_total', method=api_method)
+        if throttled:
+            SEND.backoff(chat_id, retry_after)
+        else:
+            time.sleep(retry_after)
+    return resp
 
 
-Dependencies:
+telebot.apihelper.CUSTOM_REQUEST_SENDER = _send_request
+METRICS.gauge('ig_queue_depth', SEND.depth, queue='send')
 
-instaloader
 
-pytelegrambotapi
+# -------------------- Instagram download helper --------------------
 
-pillow
+SHORTCODE_RE = re.compile(r"instagram\.com/(?:p|reel|tv)/([A-Za-z0-9_-]+)")
 
 
-Install: pip install instaloader pytelegrambotapi pillow
+def extract_shortcode(url: str) -> str:
+    m = SHORTCODE_RE.search(url)
+    if not m:
+        raise ValueError("Invalid/unsupported Instagram URL (needs /p/, /reel/, or /tv/).")
+    return m.group(1)
 
-Run: export BOT_TOKEN=<telegram-bot-token> # optional for private posts you follow # export IG_USER=your_ig_user # export IG_PASS=your_ig_pass python instagram_downloader_bot_full.py
 
-Note: Use responsibly. Only download/share content you have rights to. Instagram scraping may be restricted by Instagram's Terms. """
+def _guess_mediacount(post: Post) -> int:
+    try:
+        return post.mediacount
+    except Exception:
+        try:
+            return len(list(post.get_sidecar_nodes()))
+        except Exception:
+            return 1
+
+
+# Long-lived Instaloader sessions
+class _IGSession:
+    def __init__(self, slot: int):
+        self.slot = slot
+        self.loader: instaloader.Instaloader | None = None
+        self.failures = 0
+        self.cooldown_until = 0.0
+        self.force_login = False
+
+
+class InstaloaderPool:
+    """Fixed set of Instaloader objects handed out one caller at a time.
+
+    With credentials, the first session logs in and saves its cookies to
+    session_file; every other session (and every restart) loads that file
+    instead of logging in again. A session that hits 401/429 is put on an
+    exponential cooldown and skipped by checkout() until it expires.
+    """
+
+    def __init__(self, size: int, user: str = None, password: str = None, session_file: str = None):
+        self.user = user
+        self.password = password
+        self.session_file = session_file
+        self.cond = threading.Condition()
+        self.login_lock = threading.Lock()
+        self.sessions: List[_IGSession] = [_IGSession(i) for i in range(max(1, size))]
+        self.idle: List[_IGSession] = list(self.sessions)
+        self.size = len(self.sessions)
+
+    def _new_loader(self) -> instaloader.Instaloader:
+        return instaloader.Instaloader(
+            download_comments=False,
+            save_metadata=False,
+            compress_json=False,
+            post_metadata_txt_pattern="",
+            dirname_pattern="{target}",
+            filename_pattern="{shortcode}_{mediaid}",
+            quiet=True,
+            # fail fast on 429 and let the pool cool the session down
+            # instead of instaloader sleeping inside a worker
+            max_connection_attempts=1,
+        )
+
+    def _authenticate(self, L: instaloader.Instaloader, force_login: bool):
+        if not (self.user and self.password):
+            return
+        with self.login_lock:
+            if not force_login and self.session_file and os.path.isfile(self.session_file):
+                try:
+                    L.load_session_from_file(self.user, self.session_file)
+                    return
+                except Exception:
+                    pass
+            try:
+                L.login(self.user, self.password)
+            except Exception:
+                return  # continue anonymously
+            if self.session_file:
+                try:
+                    L.save_session_to_file(self.session_file)
+                except Exception:
+                    pass
+
+    def _prepare(self, s: _IGSession):
+        if s.loader is None:
+            L = self._new_loader()
+            self._authenticate(L, s.force_login)
+            s.loader = L
+            s.force_login = False
+
+    def warm(self):
+        """Build and authenticate every session up front."""
+        with self.cond:
+            sessions = list(self.idle)
+            self.idle.clear()
+        try:
+            for s in sessions:
+                try:
+                    self._prepare(s)
+                except Exception:
+                    pass
+        finally:
+            with self.cond:
+                self.idle.extend(sessions)
+                self.cond.notify_all()
+
+    def _acquire(self, timeout: float) -> _IGSession:
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                ready = [s for s in self.idle if s.cooldown_until <= now]
+                if ready:
+                    s = min(ready, key=lambda x: x.failures)
+                    self.idle.remove(s)
+                    return s
+                if now >= deadline:
+                    raise RuntimeError("Instagram is rate limiting us right now — try again in a few minutes.")
+                wake = min([s.cooldown_until for s in self.idle] or [deadline])
+                self.cond.wait(max(0.05, min(wake, deadline) - now))
+
+    def _release(self, s: _IGSession, error: BaseException | None):
+        status = _ig_error_status(error) if error is not None else None
+        if status is None:
+            s.failures = 0
+        else:
+            s.failures += 1
+            s.cooldown_until = time.monotonic() + min(IG_BACKOFF_MAX, IG_BACKOFF_BASE * 2 ** (s.failures - 1))
+            if status == 401:
+                # cookies rejected: rebuild with a fresh login next time
+                s.loader = None
+                s.force_login = True
+        with self.cond:
+            self.idle.append(s)
+            self.cond.notify()
+
+    @contextmanager
+    def checkout(self, timeout: float = None):
+        """Yield an authenticated Instaloader for exclusive use by the caller."""
+        s = self._acquire(IG_POOL_TIMEOUT if timeout is None else timeout)
+        error = None
+        try:
+            self._prepare(s)
+            yield s.loader
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            self._release(s, error)
+
+    def health(self) -> List[Dict[str, Any]]:
+        now = time.monotonic()
+        with self.cond:
+            return [{'slot': s.slot, 'failures': s.failures, 'in_use': s not in self.idle,
+                     'cooldown': max(0.0, round(s.cooldown_until - now, 1))} for s in self.sessions]
+
+
+# instaloader's HTTP errors read "<status> <reason> when accessing <url>"
+IG_STATUS_RE = re.compile(r"^(\d{3}) ")
+
+
+def _ig_error_status(error: BaseException) -> int | None:
+    """Map an instaloader error (or its cause chain) to 401/429, else None.
+
+    Only the leading status code of a message counts: the URL after it can
+    contain any digits. 403 is left alone, it usually means a private or
+    blocked post rather than a bad session.
+    """
+    e = error
+    while e is not None:
+        if isinstance(e, instaloader.exceptions.TooManyRequestsException):
+            return 429
+        if isinstance(e, instaloader.exceptions.LoginRequiredException):
+            return 401
+        msg = str(e)
+        m = IG_STATUS_RE.match(msg)
+        if m and m.group(1) in ('401', '429'):
+            return int(m.group(1))
+        if "login_required" in msg or "checkpoint_required" in msg:
+            return 401
+        e = e.__cause__
+    return None
+
+
+IG_POOL = InstaloaderPool(IG_POOL_SIZE, IG_USER, IG_PASS, IG_SESSION_FILE)
+for _s in IG_POOL.sessions:
+    METRICS.gauge('ig_session_cooldown_seconds',
+                  lambda s=_s: max(0.0, s.cooldown_until - time.monotonic()), slot=str(_s.slot))
+
+# Shared keep-alive session for CDN media fetches (thread-safe for plain GETs)
+HTTP = requests.Session()
+HTTP.headers['User-Agent'] = instaloader.instaloadercontext.default_user_agent()
+HTTP.mount('https://', requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=max(4, DOWNLOAD_WORKERS * 2)))
+
+
+class MediaBuffer:
+    """One downloaded file. Kept in memory until it grows past SPOOL_MAX_MEMORY,
+    then moved to a file in the owning spool's tmpdir."""
+
+    def __init__(self, spool: "MediaSpool", name: str, kind: str):
+        self.spool = spool
+        self.name = name
+        self.kind = kind  # 'photo' | 'video'
+        self.size = 0
+        self.path: str | None = None
+        self._mem: io.BytesIO | None = io.BytesIO()
+        self._fh = None
+        self._data: bytes | None = None
+
+    def in_memory(self, nbytes: int) -> bool:
+        """Would writing nbytes more stay in memory (no mkdtemp, quota reaping or file I/O)?"""
+        return self.path is None and self.size + nbytes <= SPOOL_MAX_MEMORY
+
+    def write(self, chunk: bytes):
+        if self.path is None and self.size + len(chunk) > SPOOL_MAX_MEMORY:
+            tmpdir = self.spool.ensure_dir()
+            REAPER.account(tmpdir, self.size)
+            self.path = os.path.join(tmpdir, self.name)
+            self._fh = open(self.path, 'wb')
+            self._fh.write(self._mem.getbuffer())
+            self._mem = None
+        if self._fh is not None:
+            REAPER.account(self.spool.tmpdir, len(chunk))
+        (self._fh or self._mem).write(chunk)
+        self.size += len(chunk)
+
+    def finish(self):
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+        elif self._mem is not None:
+            self._data = self._mem.getvalue()
+            self._mem = None
+
+    def payload(self) -> Any:
+        """Path on disk if spilled, else the raw bytes (both picklable)."""
+        return self.path if self.path is not None else (self._data or b'')
+
+    def open(self):
+        """Return a fresh readable file object (named, so uploads keep the extension)."""
+        if self.path is not None:
+            return open(self.path, 'rb')
+        f = io.BytesIO(self._data or b'')
+        f.name = self.name
+        return f
+
+
+class MediaSpool:
+    """Buffers for one post. The tmpdir is only created if a file spills to disk."""
+
+    def __init__(self, shortcode: str):
+        self.shortcode = shortcode
+        self.tmpdir: str | None = None
+        self.buffers: List[MediaBuffer] = []
+        self.lock = threading.Lock()
+
+    def ensure_dir(self) -> str:
+        with self.lock:
+            if self.tmpdir is None:
+                self.tmpdir = tempfile.mkdtemp(prefix=f"{TEMP_PREFIX}{self.shortcode}_", dir=TEMP_DIR)
+                REAPER.register(self.tmpdir)
+            return self.tmpdir
+
+    def new_buffer(self, name: str, kind: str) -> MediaBuffer:
+        buf = MediaBuffer(self, name, kind)
+        self.buffers.append(buf)
+        return buf
+
+    def close(self):
+        for buf in self.buffers:
+            buf.finish()
+            buf._data = None
+        if self.tmpdir:
+            REAPER.release(self.tmpdir)
+
+
+def post_media_sources(post: Post) -> List[Tuple[str, str]]:
+    """Return [(kind, cdn_url)] for every media item of a post, in carousel order."""
+    if post.typename == 'GraphSidecar':
+        out = []
+        for node in post.get_sidecar_nodes():
+            if node.is_video and node.video_url:
+                out.append(('video', node.video_url))
+            else:
+                out.append(('photo', node.display_url))
+        return out
+    if post.is_video and post.video_url:
+        return [('video', post.video_url)]
+    return [('photo', post.url)]
 
-import os import re import time import json import html import shutil import tempfile import threading from typing import List, Tuple, Dict, Any from datetime import datetime, timedelta
 
-import instaloader from instaloader import Post, InstaloaderContext from PIL import Image import telebot from telebot.types import (InlineKeyboardMarkup, InlineKeyboardButton, InputMediaPhoto, InputMediaVideo)
+def fetch_into(buf: MediaBuffer, url: str):
+    with HTTP.get(url, stream=True, timeout=HTTP_TIMEOUT) as resp:
+        resp.raise_for_status()
+        for chunk in resp.iter_content(chunk_size=256 * 1024):
+            if chunk:
+                buf.write(chunk)
+    buf.finish()
 
--------------------- Configuration --------------------
 
-BOT_TOKEN = os.getenv("BOT_TOKEN") if not BOT_TOKEN: raise SystemExit("Please export BOT_TOKEN=<your_telegram_bot_token>")
+def media_size(url: str) -> int | None:
+    """Content-Length of a CDN file from a HEAD request, or None if the CDN won't say."""
+    try:
+        with HTTP.head(url, allow_redirects=True, timeout=HTTP_TIMEOUT) as resp:
+            resp.raise_for_status()
+            return int(resp.headers['Content-Length'])
+    except Exception:
+        return None
+
+
+def resolve_post(shortcode: str) -> Tuple[List[Tuple[str, str]], Dict[str, Any]]:
+    """Look a post up on Instagram (blocking). Returns (media sources, meta)."""
+    with IG_POOL.checkout() as L, METRICS.stage('resolve'):
+        ctx: InstaloaderContext = L.context
+        post = Post.from_shortcode(ctx, shortcode)
+        sources = post_media_sources(post)
+
+        meta: Dict[str, Any] = {
+            "shortcode": shortcode,
+            "owner_username": getattr(post, "owner_username", None),
+            "caption": (post.caption or "").strip() if hasattr(post, "caption") else "",
+            "date_utc": getattr(post, "date_utc", None),
+            "mediacount": _guess_mediacount(post),
+            "permalink": f"https://www.instagram.com/p/{shortcode}/",
+            "is_video": getattr(post, "is_video", False),
+        }
+    return sources, meta
+
+
+def download_instagram_media(url: str) -> Tuple[MediaSpool, Dict[str, Any]]:
+    """
+    Resolves a post and streams its media into a MediaSpool. Returns (spool, meta).
+    Safe to call from many threads at once. Caller must spool.close() when done.
+    """
+    shortcode = extract_shortcode(url)
+    sources, meta = resolve_post(shortcode)
+
+    # CDN fetches don't need the Instagram session, so it is already back in the pool
+    spool = MediaSpool(shortcode)
+    try:
+        with METRICS.stage('download'):
+            for idx, (kind, media_url) in enumerate(sources, start=1):
+                ext = 'mp4' if kind == 'video' else 'jpg'
+                fetch_into(spool.new_buffer(f"{shortcode}_{idx}.{ext}", kind), media_url)
+    except Exception:
+        spool.close()
+        raise
 
-DATA_DIR = os.getenv("DATA_DIR", "./data") os.makedirs(DATA_DIR, exist_ok=True)
+    if not spool.buffers:
+        spool.close()
+        raise RuntimeError("No downloadable media found for this URL.")
 
-SETTINGS_FILE = os.path.join(DATA_DIR, "settings.json") STATS_FILE = os.path.join(DATA_DIR, "stats.json") TEMP_DIR = os.getenv("TEMP_DIR", None) or tempfile.gettempdir() TEMP_PREFIX = os.getenv("TEMP_PREFIX", "ig_dl_") TEMP_MAX_AGE_MIN = int(os.getenv("TEMP_MAX_AGE_MIN", "30"))  # cleanup age RATE_LIMIT_PER_MIN = int(os.getenv("RATE_LIMIT_PER_MIN", "5")) TELEGRAM_ALBUM_MAX = 10 OWNER_ID = os.getenv("OWNER_ID")  # optional: for admin features
+    return spool, meta
 
-IG_USER = os.getenv("IG_USER") IG_PASS = os.getenv("IG_PASS")
 
--------------------- Utilities & Stores --------------------
+# -------------------- Collage & hashtag helpers --------------------
 
-bot = telebot.TeleBot(BOT_TOKEN, parse_mode="HTML")
+COLLAGE_CACHE: "OrderedDict[str, bytes]" = OrderedDict()  # shortcode -> rendered JPEG
+COLLAGE_CACHE_LOCK = threading.Lock()
 
-URL_RE = re.compile(r"(https?://(?:www.)?instagram.com/(?:p|reel|tv)/[A-Za-z0-9_-]+)", re.IGNORECASE) SHORT_REDIR_RE = re.compile(r"(https?://(?:www.)?(?:instagr.am|instagram.com)/(?:p|reel|tv)/[A-Za-z0-9_-]+)", re.IGNORECASE)
 
-Thread-safe JSON store
+def build_collage(shortcode: str, photos: List["MediaBuffer"]) -> bytes:
+    """Return the collage JPEG for a post, from COLLAGE_CACHE or freshly rendered."""
+    with COLLAGE_CACHE_LOCK:
+        cached = COLLAGE_CACHE.get(shortcode)
+        if cached is not None:
+            COLLAGE_CACHE.move_to_end(shortcode)
+            return cached
+    sources = [b.payload() for b in photos[:4]]
+    with METRICS.stage('collage'):
+        try:
+            data = COLLAGE_POOL.submit(render_collage, sources).result() if COLLAGE_POOL else None
+        except BrokenProcessPool:  # a worker died; fork pools can't replace it safely now
+            data = None
+        if data is None:
+            data = render_collage(sources)
+    with COLLAGE_CACHE_LOCK:
+        COLLAGE_CACHE[shortcode] = data
+        while len(COLLAGE_CACHE) > COLLAGE_CACHE_MAX:
+            COLLAGE_CACHE.popitem(last=False)
+    return data
 
-class JSONStore: def init(self, path: str, default: dict = None): self.path = path self.lock = threading.RLock() self.data = default or {} self._load()
 
-def _load(self):
-    if os.path.isfile(self.path):
-        try:
-            with open(self.path, "r", encoding="utf-8") as f:
-                self.data = json.load(f)
-        except Exception:
-            self.data = {}
+HASHTAG_RE = re.compile(r"#([\w\u00C0-\u024F]+)")
 
-def _save(self):
-    tmp = self.path + ".tmp"
-    with open(tmp, "w", encoding="utf-8") as f:
-        json.dump(self.data, f, ensure_ascii=False, indent=2)
-    os.replace(tmp, self.path)
 
-def get(self, key, default=None):
-    with self.lock:
-        return self.data.get(str(key), default)
+def extract_hashtags(text: str, max_tags: int = 10) -> List[str]:
+    if not text:
+        return []
+    tags = [f"#{t}" for t in HASHTAG_RE.findall(text)]
+    # keep unique preserving order
+    seen = set()
+    out = []
+    for t in tags:
+        if t.lower() not in seen:
+            seen.add(t.lower())
+            out.append(t)
+        if len(out) >= max_tags:
+            break
+    return out
 
-def set(self, key, value):
-    with self.lock:
-        self.data[str(key)] = value
-        self._save()
 
-def update_subkey(self, key, subkey, value):
-    with self.lock:
-        k = str(key)
-        if k not in self.data:
-            self.data[k] = {}
-        self.data[k][subkey] = value
-        self._save()
+# -------------------- Engine steps --------------------
+# The pipeline, the album sender and the handler bodies are written once, as
+# generators ("steps") that yield what they need done: a Bot API Call, a Wait
+# on a download future, or Blocking work. run_steps() carries them out on the
+# threaded engine, arun_steps() on the asyncio one; the value (or exception)
+# is sent back in. Steps compose with `yield from`.
 
-def inc(self, key, subkey, amount=1):
-    with self.lock:
-        k = str(key)
-        if k not in self.data:
-            self.data[k] = {}
-        self.data[k][subkey] = self.data[k].get(subkey, 0) + amount
-        self._save()
+API_ERRORS: Tuple[type, ...] = (telebot.apihelper.ApiTelegramException,)
+if aiohttp is not None:
+    API_ERRORS += (asyncio_helper.ApiTelegramException,)
 
-PREFS = JSONStore(SETTINGS_FILE, default={}) STATS = JSONStore(STATS_FILE, default={})
 
-Rate limiting token buckets
+class Call:
+    """A Bot API call by telebot method name, made on the running engine's bot."""
+    __slots__ = ('method', 'args', 'kwargs')
 
-TOKENS: Dict[int, Tuple[int, float]] = {}  # chat_id -> (tokens, last_refill_ts) TOKENS_LOCK = threading.Lock()
+    def __init__(self, method: str, *args, **kwargs):
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
 
-def rate_ok(chat_id: int) -> bool: now = time.time() with TOKENS_LOCK: tokens, last = TOKENS.get(chat_id, (RATE_LIMIT_PER_MIN, now)) if now - last >= 60: tokens = RATE_LIMIT_PER_MIN last = now if tokens <= 0: TOKENS[chat_id] = (tokens, last) return False tokens -= 1 TOKENS[chat_id] = (tokens, last) return True
+    def run(self):
+        return getattr(bot, self.method)(*self.args, **self.kwargs)
 
--------------------- Instagram download helper --------------------
+    async def arun(self):
+        return await getattr(ABOT, self.method)(*self.args, **self.kwargs)
 
-SHORTCODE_RE = re.compile(r"instagram.com/(?:p|reel|tv)/([A-Za-z0-9_-]+)")
 
-def extract_shortcode(url: str) -> str: m = SHORTCODE_RE.search(url) if not m: raise ValueError("Invalid/unsupported Instagram URL (needs /p/, /reel/, or /tv/).") return m.group(1)
+class Wait:
+    """The result of a download or link-resolve future."""
+    __slots__ = ('future',)
 
-def _guess_mediacount(post: Post) -> int: try: return post.mediacount except Exception: try: return len(list(post.get_sidecar_nodes())) except Exception: return 1
+    def __init__(self, future):
+        self.future = future
 
-def download_instagram_media(url: str, login_user: str = None, login_pass: str = None) -> Tuple[str, List[str], Dict[str, Any]]: """ Downloads media into a dedicated temp folder and returns (tmpdir, files, meta) Caller must delete tmpdir when done. """ shortcode = extract_shortcode(url)
+    def run(self):
+        return self.future.result()
 
-L = instaloader.Instaloader(
-    download_comments=False,
-    save_metadata=False,
-    compress_json=False,
-    post_metadata_txt_pattern="",
-    dirname_pattern="{target}",
-    filename_pattern="{shortcode}_{mediaid}"
-)
+    async def arun(self):
+        # shield: other chats may be waiting on the same download
+        return await asyncio.shield(asyncio.wrap_future(self.future))
 
-if login_user and login_pass:
-    try:
-        L.login(login_user, login_pass)
-    except Exception:
-        pass
 
-ctx: InstaloaderContext = L.context
-post = Post.from_shortcode(ctx, shortcode)
-
-tmpdir = tempfile.mkdtemp(prefix=f"{TEMP_PREFIX}{shortcode}_")
-
-cwd = os.getcwd()
-try:
-    os.chdir(tmpdir)
-    L.download_post(post, target="dl")
-finally:
-    os.chdir(cwd)
-
-media_dir = os.path.join(tmpdir, "dl")
-files: List[str] = []
-if os.path.isdir(media_dir):
-    for name in sorted(os.listdir(media_dir)):
-        nl = name.lower()
-        if nl.endswith((".jpg", ".jpeg", ".png", ".mp4")):
-            files.append(os.path.join(media_dir, name))
-
-if not files:
-    raise RuntimeError("No downloadable media found for this URL.")
-
-meta: Dict[str, Any] = {
-    "shortcode": shortcode,
-    "owner_username": getattr(post, "owner_username", None),
-    "caption": (post.caption or "").strip() if hasattr(post, "caption") else "",
-    "date_utc": getattr(post, "date_utc", None),
-    "mediacount": _guess_mediacount(post),
-    "permalink": f"https://www.instagram.com/p/{shortcode}/",
-    "is_video": getattr(post, "is_video", False),
-}
-
-return tmpdir, files, meta
-
--------------------- Collage & hashtag helpers --------------------
-
-def create_collage_image(image_paths: List[str], out_path: str, size: int = 800) -> str: """Create a square collage (up to 4 images -> 2x2). Returns path to saved image.""" imgs = [Image.open(p).convert("RGB") for p in image_paths[:4]] n = len(imgs) if n == 0: raise ValueError("No images to make collage")
-
-# decide grid
-grid = (1, 1)
-if n == 1:
-    grid = (1, 1)
-elif n == 2:
-    grid = (2, 1)
-else:
-    grid = (2, 2)
-
-cols, rows = grid
-thumb_w = size // cols
-thumb_h = size // rows
-
-new_im = Image.new('RGB', (thumb_w * cols, thumb_h * rows), (255, 255, 255))
-
-i = 0
-for r in range(rows):
-    for c in range(cols):
-        if i >= n:
-            break
-        img = imgs[i].copy()
-        img.thumbnail((thumb_w, thumb_h), Image.Resampling.LANCZOS)
-        # center paste
-        x = c * thumb_w + (thumb_w - img.width) // 2
-        y = r * thumb_h + (thumb_h - img.height) // 2
-        new_im.paste(img, (x, y))
-        i += 1
-
-new_im.save(out_path, format='JPEG', quality=85)
-for im in imgs:
-    try:
-        im.close()
-    except Exception:
-        pass
-return out_path
+class Blocking:
+    """Blocking work (a membership lookup, disk or SQLite writes): inline on a
+    handler thread, in a worker thread when on the event loop."""
+    __slots__ = ('fn', 'args')
 
-HASHTAG_RE = re.compile(r"#([\w\u00C0-\u024F]+)")
+    def __init__(self, fn, *args):
+        self.fn = fn
+        self.args = args
 
-def extract_hashtags(text: str, max_tags: int = 10) -> List[str]: if not text: return [] tags = [f"#{t}" for t in HASHTAG_RE.findall(text)] # keep unique preserving order seen = set() out = [] for t in tags: if t.lower() not in seen: seen.add(t.lower()) out.append(t) if len(out) >= max_tags: break return out
+    def run(self):
+        return self.fn(*self.args)
 
--------------------- Bot helpers --------------------
+    async def arun(self):
+        return await asyncio.to_thread(self.fn, *self.args)
 
-def sanitize_url(text: str) -> str | None: m = URL_RE.search(text) or SHORT_REDIR_RE.search(text) if not m: return None url = m.group(1) if not url.endswith('/'): url += '/' url = url.split('?')[0].split('#')[0] return url
 
-def fmt_meta_caption(meta: dict, include_body: bool) -> str: owner = meta.get('owner_username') or 'unknown' count = meta.get('mediacount', 1) link = html.escape(meta.get('permalink', '')) sc = html.escape(meta.get('shortcode', '')) header = f"<b>Instagram</b> • @{html.escape(owner)}  •  {count} media" body = "" if include_body: cap = (meta.get('caption') or '').strip() if cap: if len(cap) > 900: cap = cap[:900].rstrip() + '…' body = '\n' + html.escape(cap) footer = f"\n<a href="{link}">Link</a>  |  <code>{sc}</code>" return header + body + footer
+def run_steps(steps):
+    """Drive a steps generator on the calling thread; returns its return value."""
+    value, error = None, None
+    while True:
+        try:
+            effect = steps.send(value) if error is None else steps.throw(error)
+        except StopIteration as done:
+            return done.value
+        try:
+            value, error = effect.run(), None
+        except BaseException as e:
+            value, error = None, e
 
-Settings keyboard
 
-def settings_keyboard(chat_id: int) -> InlineKeyboardMarkup: mode = PREFS.get(chat_id, {}).get('mode', 'media') cap = 'on' if PREFS.get(chat_id, {}).get('caption_on', True) else 'off' kb = InlineKeyboardMarkup() kb.row(InlineKeyboardButton(f"Mode: {mode} (tap to toggle)", callback_data=f"toggle:mode")) kb.row(InlineKeyboardButton(f"Caption: {cap} (tap to toggle)", callback_data=f"toggle:caption")) kb.row(InlineKeyboardButton("Clear my stats", callback_data="clear:stats")) return kb
+async def arun_steps(steps):
+    """run_steps() for the asyncio engine."""
+    value, error = None, None
+    while True:
+        try:
+            effect = steps.send(value) if error is None else steps.throw(error)
+        except StopIteration as done:
+            return done.value
+        try:
+            value, error = await effect.arun(), None
+        except BaseException as e:
+            value, error = None, e
+
+
+# -------------------- Bot helpers --------------------
+
+def sanitize_url(text: str) -> str | None:
+    m = URL_RE.search(text) or SHORT_REDIR_RE.search(text)
+    if not m:
+        return None
+    url = m.group(1)
+    if not url.endswith('/'):
+        url += '/'
+    url = url.split('?')[0].split('#')[0]
+    return url
+
+
+def fmt_meta_caption(meta: dict, include_body: bool) -> str:
+    owner = meta.get('owner_username') or 'unknown'
+    count = meta.get('mediacount', 1)
+    link = html.escape(meta.get('permalink', ''))
+    sc = html.escape(meta.get('shortcode', ''))
+    header = f"<b>Instagram</b> • @{html.escape(owner)}  •  {count} media"
+    body = ""
+    if include_body:
+        cap = (meta.get('caption') or '').strip()
+        if cap:
+            if len(cap) > 900:
+                cap = cap[:900].rstrip() + '…'
+            body = '\n' + html.escape(cap)
+    footer = f'\n<a href="{link}">Link</a>  |  <code>{sc}</code>'
+    return header + body + footer
+
+
+def _sent_file_ref(m) -> Tuple[str, str | None]:
+    """Return (kind, file_id) of the media attached to a sent Message."""
+    if getattr(m, 'photo', None):
+        return 'photo', m.photo[-1].file_id  # largest size is last
+    if getattr(m, 'video', None):
+        return 'video', m.video.file_id
+    if getattr(m, 'document', None):
+        return 'document', m.document.file_id
+    return 'unknown', None
+
+
+INPUT_MEDIA = {'photo': InputMediaPhoto, 'video': InputMediaVideo, 'document': InputMediaDocument}
+SINGLE_SENDERS = {'photo': 'send_photo', 'video': 'send_video', 'document': 'send_document'}
+
+
+def _send_single(chat_id: int, item: Dict[str, Any], caption: str = None):
+    method = SINGLE_SENDERS[item['kind']]
+    if item.get('file_id') or item.get('url'):
+        return (yield Call(method, chat_id, item.get('file_id') or item['url'], caption=caption))
+    with item['buffer'].open() as fh:
+        return (yield Call(method, chat_id, fh, caption=caption))
+
+
+def send_album(chat_id: int, media: List[Dict[str, Any]], caption: str = None):
+    """Steps: send media items ({kind, buffer}, {kind, file_id} or {kind, url}) as albums.
+
+    Items go out in sendMediaGroup chunks of TELEGRAM_ALBUM_MAX with the
+    caption on the very first item. If Telegram rejects a chunk, that chunk
+    is retried one item at a time and items that still fail are returned
+    with file_id None; the caption moves to the first item that does go
+    out, or is sent as a message if none of the items could take it.
+    Raises only if nothing could be sent. Returns cache items
+    ({kind, file_id, cap, group}) in input order.
+    """
+    sent: List[Dict[str, Any]] = []
+    errors: List[Exception] = []
+    cap = caption  # moves on to the next item that actually goes out
+    for start in range(0, len(media), TELEGRAM_ALBUM_MAX):
+        chunk = media[start:start + TELEGRAM_ALBUM_MAX]
+        if len(chunk) > 1:
+            group = start // TELEGRAM_ALBUM_MAX
+            try:
+                with ExitStack() as stack:
+                    album = []
+                    for i, item in enumerate(chunk):
+                        src = item.get('file_id') or item.get('url') or stack.enter_context(item['buffer'].open())
+                        album.append(INPUT_MEDIA[item['kind']](src, caption=cap if i == 0 else None, parse_mode='HTML'))
+                    msgs = yield Call('send_media_group', chat_id, album)
+                for i, (item, m) in enumerate(zip(chunk, msgs)):
+                    sent.append({'kind': item['kind'], 'file_id': _sent_file_ref(m)[1],
+                                 'cap': cap is not None and i == 0, 'group': group})
+                cap = None
+                continue
+            except API_ERRORS:
+                pass  # fall back to individual sends for this chunk
+        for item in chunk:
+            try:
+                file_id = _sent_file_ref((yield from _send_single(chat_id, item, cap)))[1]
+            except Exception as e:
+                errors.append(e)
+                file_id = None
+            sent.append({'kind': item['kind'], 'file_id': file_id, 'cap': cap is not None and file_id is not None})
+            if file_id:
+                cap = None
+    if errors and not any(s['file_id'] for s in sent):
+        raise errors[0]
+    if cap is not None:
+        # every item that could carry it failed; don't lose the caption and hashtags
+        try:
+            yield Call('send_message', chat_id, cap, disable_web_page_preview=True)
+        except Exception:
+            pass
+    return sent
 
--------------------- Background cleaner --------------------
 
-def temp_cleaner_worker(): while True: try: cutoff = time.time() - (TEMP_MAX_AGE_MIN * 60) for name in os.listdir(TEMP_DIR): if not name.startswith(TEMP_PREFIX): continue path = os.path.join(TEMP_DIR, name) try: mtime = os.path.getmtime(path) if mtime < cutoff: if os.path.isdir(path): shutil.rmtree(path, ignore_errors=True) else: try: os.remove(path) except Exception: pass except Exception: pass except Exception: pass time.sleep(60)  # run every minute
+def _send_cached(chat_id: int, entry: dict, mode: str, caption: str):
+    """Steps: re-send a FILE_CACHE entry by file_id, keeping its album grouping. Returns number of items sent."""
+    if mode == 'document':
+        yield Call('send_message', chat_id, caption, disable_web_page_preview=True)
+    runs: List[List[dict]] = []
+    for item in entry['items']:
+        if runs and item.get('group') is not None and runs[-1][-1].get('group') == item['group']:
+            runs[-1].append(item)
+        else:
+            runs.append([item])
+    sent = 0
+    for run in runs:
+        cap = caption if run[0].get('cap') else None
+        sent += sum(1 for s in (yield from send_album(chat_id, run, cap)) if s['file_id'])
+    return sent
+
+
+# Settings keyboard
+def settings_keyboard(chat_id: int) -> InlineKeyboardMarkup:
+    mode = PREFS.get(chat_id, {}).get('mode', 'media')
+    cap = 'on' if PREFS.get(chat_id, {}).get('caption_on', True) else 'off'
+    link = 'on' if PREFS.get(chat_id, {}).get('passthrough', False) else 'off'
+    kb = InlineKeyboardMarkup()
+    kb.row(InlineKeyboardButton(f"Mode: {mode} (tap to toggle)", callback_data=f"toggle:mode"))
+    kb.row(InlineKeyboardButton(f"Caption: {cap} (tap to toggle)", callback_data=f"toggle:caption"))
+    kb.row(InlineKeyboardButton(f"Passthrough: {link} (tap to toggle)", callback_data=f"toggle:passthrough"))
+    kb.row(InlineKeyboardButton("Clear my stats", callback_data="clear:stats"))
+    return kb
+
+
+# -------------------- Background cleaner --------------------
+
+def _remove_path(path: str):
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        try:
+            os.remove(path)
+        except Exception:
+            pass
 
-cleaner_thread = threading.Thread(target=temp_cleaner_worker, daemon=True) cleaner_thread.start()
 
--------------------- Commands --------------------
+def _path_size(path: str) -> int:
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    total = 0
+    for dirpath, _, names in os.walk(path):
+        for name in names:
+            try:
+                total += os.path.getsize(os.path.join(dirpath, name))
+            except OSError:
+                pass
+    return total
+
+
+class TempReaper:
+    """In-memory registry of our temp paths under TEMP_DIR.
+
+    Spools register their tmpdir when it is created and account every byte
+    they spill into it; close() releases it. Expiry is driven by a heap of
+    creation times, so the reaper thread sleeps until the next deadline
+    instead of scanning the directory. When accounted bytes exceed the quota,
+    orphans and then expired paths are reclaimed (oldest first) before the
+    write is refused. The directory is only listed once, by adopt_orphans().
+    """
+
+    def __init__(self, root: str, prefix: str, max_age: float, quota: int):
+        self.root = root
+        self.prefix = prefix
+        self.max_age = max_age
+        self.quota = quota
+        self.cond = threading.Condition()
+        self.paths: Dict[str, Dict[str, Any]] = {}  # path -> {created, bytes, orphan}
+        self.heap: List[Tuple[float, str]] = []
+        self.total = 0
+
+    def register(self, path: str, created: float = None, size: int = 0, orphan: bool = False):
+        created = time.time() if created is None else created
+        with self.cond:
+            self.paths[path] = {'created': created, 'bytes': size, 'orphan': orphan}
+            self.total += size
+            heapq.heappush(self.heap, (created, path))
+            self.cond.notify()
+
+    def account(self, path: str, nbytes: int):
+        """Record nbytes about to be written under path; raises if over quota."""
+        with self.cond:
+            rec = self.paths.get(path)
+            if rec is None:
+                raise RuntimeError("Temporary download folder was reclaimed.")
+            rec['bytes'] += nbytes
+            self.total += nbytes
+            victims = self._pick_victims(exclude=path) if self.total > self.quota else []
+        for victim in victims:
+            _remove_path(victim)
+        with self.cond:
+            if self.total > self.quota:
+                rec['bytes'] -= nbytes
+                self.total -= nbytes
+                raise RuntimeError("Temporary storage is full — try again in a few minutes.")
+
+    def release(self, path: str):
+        with self.cond:
+            rec = self.paths.pop(path, None)
+            if rec is not None:
+                self.total -= rec['bytes']
+        _remove_path(path)
+
+    def _pick_victims(self, exclude: str = None) -> List[str]:
+        """Unregister orphans, then expired paths, oldest first, until under quota."""
+        cutoff = time.time() - self.max_age
+        ranked = sorted((p for p in self.paths.items() if p[0] != exclude),
+                        key=lambda p: (not p[1]['orphan'], p[1]['created']))
+        victims = []
+        for path, rec in ranked:
+            if self.total <= self.quota:
+                break
+            if rec['orphan'] or rec['created'] < cutoff:
+                del self.paths[path]
+                self.total -= rec['bytes']
+                victims.append(path)
+        return victims
+
+    def adopt_orphans(self):
+        """One startup scan: register leftovers from a previous run."""
+        try:
+            names = os.listdir(self.root)
+        except Exception:
+            return
+        for name in names:
+            if not name.startswith(self.prefix):
+                continue
+            path = os.path.join(self.root, name)
+            try:
+                self.register(path, os.path.getmtime(path), _path_size(path), orphan=True)
+            except Exception:
+                pass
+
+    def usage(self) -> Dict[str, Any]:
+        with self.cond:
+            return {'paths': len(self.paths), 'bytes': self.total, 'quota': self.quota}
+
+    def run(self):
+        while True:
+            expired = []
+            with self.cond:
+                now = time.time()
+                while self.heap:
+                    created, path = self.heap[0]
+                    rec = self.paths.get(path)
+                    if rec is None or rec['created'] != created:
+                        heapq.heappop(self.heap)  # released or re-registered
+                        continue
+                    if created + self.max_age > now:
+                        break
+                    heapq.heappop(self.heap)
+                    del self.paths[path]
+                    self.total -= rec['bytes']
+                    expired.append(path)
+                if not expired:
+                    timeout = (self.heap[0][0] + self.max_age - now) if self.heap else None
+                    self.cond.wait(timeout)
+            for path in expired:
+                _remove_path(path)
+
+
+REAPER = TempReaper(TEMP_DIR, TEMP_PREFIX, TEMP_MAX_AGE_MIN * 60, TEMP_QUOTA_MB * 1024 * 1024)
+
+
+def temp_cleaner_worker():
+    REAPER.adopt_orphans()
+    REAPER.run()
+
+
+cleaner_thread = threading.Thread(target=temp_cleaner_worker, daemon=True)
+cleaner_thread.start()
+
+# -------------------- Commands --------------------
+
+# ---------- Channel-join verification (configurable) ----------
+# Set either CHANNEL_USERNAME (preferred) or CHANNEL_ID. Also you can control enforcement mode:
+# CHANNEL_VERIFICATION_MODE = 'force' (default) -> block until joined
+# CHANNEL_VERIFICATION_MODE = 'soft' -> show warning but allow continue
+
+CHANNEL_USERNAME = os.getenv("CHANNEL_USERNAME")  # e.g. "@MyChannel"
+CHANNEL_ID = os.getenv("CHANNEL_ID")  # e.g. -1001234567890
+CHANNEL_VERIFICATION_MODE = os.getenv("CHANNEL_VERIFICATION_MODE", "force").lower()
+MEMBER_CACHE_TTL_POS = float(os.getenv("MEMBER_CACHE_TTL_POS", "900"))  # seconds a "member" answer is trusted
+MEMBER_CACHE_TTL_NEG = float(os.getenv("MEMBER_CACHE_TTL_NEG", "60"))  # seconds a "not member" answer is trusted
+MEMBER_CACHE_MAX = int(os.getenv("MEMBER_CACHE_MAX", "50000"))
+
+
+class MembershipCache:
+    """LRU of user_id -> (is_member, expires_at) with separate TTLs for yes/no.
+
+    Concurrent lookups for a user that is already being checked wait for that
+    check instead of issuing another get_chat_member call. Failed checks are
+    not cached.
+    """
+
+    def __init__(self, ttl_pos: float, ttl_neg: float, max_entries: int):
+        self.ttl_pos = ttl_pos
+        self.ttl_neg = ttl_neg
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.data: "OrderedDict[int, Tuple[bool, float]]" = OrderedDict()
+        self.inflight: Dict[int, threading.Event] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def get(self, user_id: int, loader) -> bool:
+        while True:
+            with self.lock:
+                entry = self.data.get(user_id)
+                if entry is not None and entry[1] > time.monotonic():
+                    self.data.move_to_end(user_id)
+                    self.hits += 1
+                    return entry[0]
+                waiter = self.inflight.get(user_id)
+                if waiter is None:
+                    self.misses += 1
+                    done = self.inflight[user_id] = threading.Event()
+                    break
+                self.coalesced += 1
+            waiter.wait()
+            with self.lock:
+                entry = self.data.get(user_id)
+                if entry is not None:
+                    self.hits += 1
+                    return entry[0]
+            # the check we waited on failed: do our own
 
----------- Channel-join verification (configurable) ----------
+        try:
+            is_member = loader(user_id)
+            with self.lock:
+                ttl = self.ttl_pos if is_member else self.ttl_neg
+                self.data[user_id] = (is_member, time.monotonic() + ttl)
+                self.data.move_to_end(user_id)
+                while len(self.data) > self.max_entries:
+                    self.data.popitem(last=False)
+            return is_member
+        finally:
+            with self.lock:
+                self.inflight.pop(user_id, None)
+            done.set()
+
+    def invalidate(self, user_id: int):
+        with self.lock:
+            self.data.pop(user_id, None)
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'entries': len(self.data),
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'hit_rate': (self.hits / total) if total else 0.0,
+            }
+
+
+MEMBER_CACHE = MembershipCache(MEMBER_CACHE_TTL_POS, MEMBER_CACHE_TTL_NEG, MEMBER_CACHE_MAX)
+
+
+def _fetch_membership(user_id: int) -> bool:
+    target = CHANNEL_ID or CHANNEL_USERNAME
+    member = bot.get_chat_member(target, user_id)
+    if member and member.status in ('creator', 'administrator', 'member', 'restricted'):
+        return True
+    return False
+
+
+def user_is_member_of_channel(user_id: int) -> bool:
+    """Return True if CHANNEL_USERNAME/CHANNEL_ID not configured or user is member/subscriber.
+    If channel not configured then verification is considered disabled.
+    Answers are cached in MEMBER_CACHE.
+    """
+    if not CHANNEL_USERNAME and not CHANNEL_ID:
+        return True  # verification disabled
+    try:
+        return MEMBER_CACHE.get(user_id, _fetch_membership)
+    except Exception:
+        # If we cannot check due to API error or bot lack of access, treat based on mode:
+        # - 'force': treat as not verified (block)
+        # - 'soft': allow through (warn only)
+        return False if CHANNEL_VERIFICATION_MODE == 'force' else True
 
-Set either CHANNEL_USERNAME (preferred) or CHANNEL_ID. Also you can control enforcement mode:
 
-CHANNEL_VERIFICATION_MODE = 'force' (default) -> block until joined
+def channel_member(user_id: int):
+    """Steps: user_is_member_of_channel; a cache miss calls getChatMember, so it is Blocking work."""
+    if not CHANNEL_USERNAME and not CHANNEL_ID:
+        return True  # verification disabled
+    return (yield Blocking(user_is_member_of_channel, user_id))
 
-CHANNEL_VERIFICATION_MODE = 'soft' -> show warning but allow continue
 
-CHANNEL_USERNAME = os.getenv("CHANNEL_USERNAME")  # e.g. "@MyChannel" CHANNEL_ID = os.getenv("CHANNEL_ID")  # e.g. -1001234567890 CHANNEL_VERIFICATION_MODE = os.getenv("CHANNEL_VERIFICATION_MODE", "force").lower()
+def ensure_channel_join_prompt(chat_id: int, user_id: int):
+    """Steps: if user not member, send a prompt with join button and a "I've Joined ✅" re-check button."""
+    # If verification mode is soft, send a one-time warning but allow usage
+    if CHANNEL_VERIFICATION_MODE == 'soft':
+        yield Call('send_message', chat_id, SOFT_JOIN_TEXT)
+        return True
 
-def user_is_member_of_channel(user_id: int) -> bool: """Return True if CHANNEL_USERNAME/CHANNEL_ID not configured or user is member/subscriber. If channel not configured then verification is considered disabled. """ if not CHANNEL_USERNAME and not CHANNEL_ID: return True  # verification disabled try: target = CHANNEL_ID or CHANNEL_USERNAME member = bot.get_chat_member(target, user_id) if member and member.status in ('creator', 'administrator', 'member', 'restricted'): return True return False except Exception: # If we cannot check due to API error or bot lack of access, treat based on mode: # - 'force': treat as not verified (block) # - 'soft': allow through (warn only) return False if CHANNEL_VERIFICATION_MODE == 'force' else True
+    # For 'force' mode, require join
+    if (yield from channel_member(user_id)):
+        return True
+    yield Call('send_message', chat_id, JOIN_TEXT, reply_markup=join_keyboard())
+    return False
 
-def ensure_channel_join_prompt(chat_id: int, user_id: int): """If user not member, send a prompt with join button and a "I've Joined ✅" re-check button.""" # If verification mode is soft, send a one-time warning but allow usage if CHANNEL_VERIFICATION_MODE == 'soft': bot.send_message(chat_id, ( "⚠️ It looks like you haven't joined our channel. You can still use the bot, but please consider joining to support us. " "Join: " + (CHANNEL_USERNAME or str(CHANNEL_ID) or "(channel)") )) return True
 
-# For 'force' mode, require join
-if user_is_member_of_channel(user_id):
-    return True
-join_target = CHANNEL_USERNAME or CHANNEL_ID or ""
-text = (
-    "Please join our channel to continue using this bot.
+SOFT_JOIN_TEXT = (
+    "⚠️ It looks like you haven't joined our channel. You can still use the bot, but please consider joining to support us. "
+    "Join: " + (CHANNEL_USERNAME or str(CHANNEL_ID or "") or "(channel)")
+)
+JOIN_TEXT = (
+    "Please join our channel to continue using this bot.\n\n"
+    "After joining, tap <b>I've Joined ✅</b> to continue."
+)
 
-" "After joining, tap <b>I've Joined ✅</b> to continue." ) kb = InlineKeyboardMarkup() if CHANNEL_USERNAME: kb.row(InlineKeyboardButton("Join Channel 🔗", url=f"https://t.me/{CHANNEL_USERNAME.lstrip('@')}") ) elif CHANNEL_ID: kb.row(InlineKeyboardButton("Open Channel", url="https://t.me/")) kb.row(InlineKeyboardButton("I've Joined ✅ — Check", callback_data="check:joined")) bot.send_message(chat_id, text, reply_markup=kb) return False
 
-@bot.message_handler(commands=['start', 'help']) def cmd_start(msg): cid = msg.chat.id uid = msg.from_user.id # initialize defaults if PREFS.get(cid) is None: PREFS.set(cid, {'mode': 'media', 'caption_on': True})
+def join_keyboard() -> InlineKeyboardMarkup:
+    kb = InlineKeyboardMarkup()
+    if CHANNEL_USERNAME:
+        kb.row(InlineKeyboardButton("Join Channel 🔗", url=f"https://t.me/{CHANNEL_USERNAME.lstrip('@')}"))
+    elif CHANNEL_ID:
+        kb.row(InlineKeyboardButton("Open Channel", url="https://t.me/"))
+    kb.row(InlineKeyboardButton("I've Joined ✅ — Check", callback_data="check:joined"))
+    return kb
 
-# Channel verification: if configured, require membership
-if not user_is_member_of_channel(uid):
-    ensure_channel_join_prompt(cid, uid)
-    return
 
-bot.reply_to(msg, (
-    "👋 Send me a public Instagram post/reel/tv URL (single or multiple lines) and I’ll fetch the media.
+def start_steps(msg):
+    cid = msg.chat.id
+    uid = msg.from_user.id
+    # initialize defaults (PREFS is write-through: a SQLite commit)
+    yield Blocking(init_prefs, cid)
 
-" "Commands: " "• /settings — quick toggles (mode, caption) " "• /mode media|document — set default send mode " "• /stats — show your usage stats
+    # Channel verification: if configured, require membership
+    if not (yield from channel_member(uid)):
+        yield from ensure_channel_join_prompt(cid, uid)
+        return
 
-" "<i>Only download/share content you’re allowed to. Scraping may be restricted by Instagram's Terms.</i>" ), reply_markup=settings_keyboard(cid))
+    yield Call('reply_to', msg, START_TEXT, reply_markup=settings_keyboard(cid))
 
-@bot.message_handler(commands=['settings']) def cmd_settings(msg): bot.reply_to(msg, "⚙️ Settings", reply_markup=settings_keyboard(msg.chat.id))
 
-@bot.callback_query_handler(func=lambda c: c.data and (c.data.startswith('toggle:') or c.data.startswith('clear:') or c.data.startswith('check:'))) def on_toggle(cb): chat_id = cb.message.chat.id if cb.data == 'toggle:mode': cur = PREFS.get(chat_id, {}).get('mode', 'media') new_mode = 'document' if cur == 'media' else 'media' PREFS.update_subkey(chat_id, 'mode', new_mode) bot.answer_callback_query(cb.id, f"Mode → {new_mode}") elif cb.data == 'toggle:caption': cur = PREFS.get(chat_id, {}).get('caption_on', True) PREFS.update_subkey(chat_id, 'caption_on', not cur) bot.answer_callback_query(cb.id, f"Caption → {'on' if not cur else 'off'}") elif cb.data == 'clear:stats': STATS.set(chat_id, {}) bot.answer_callback_query(cb.id, "Stats cleared") elif cb.data == 'check:joined': # Re-check membership for the user who pressed the button user_id = cb.from_user.id if user_is_member_of_channel(user_id): bot.answer_callback_query(cb.id, "Thanks — membership confirmed ✅") try: bot.edit_message_text("Thank you for joining! Use /start to begin.", chat_id, cb.message.message_id) except Exception: pass else: bot.answer_callback_query(cb.id, "Still not a member — please join the channel first.") # refresh keyboard try: bot.edit_message_reply_markup(chat_id, cb.message.message_id, reply_markup=settings_keyboard(chat_id)) except Exception: pass
+@bot.message_handler(commands=['start', 'help'])
+def cmd_start(msg):
+    run_steps(start_steps(msg))
 
-@bot.message_handler(commands=['mode']) def cmd_mode(msg): parts = msg.text.strip().split(maxsplit=1) if len(parts) == 1: mode = PREFS.get(msg.chat.id, {}).get('mode', 'media') bot.reply_to(msg, f"Current mode: <b>{mode}</b>\nUse /mode media or /mode document.") return choice = parts[1].strip().lower() if choice not in ('media', 'document'): bot.reply_to(msg, "Use: /mode media  or  /mode document") return PREFS.update_subkey(msg.chat.id, 'mode', choice) bot.reply_to(msg, f"✅ Mode updated to <b>{choice}</b>")
 
-@bot.message_handler(commands=['stats']) def cmd_stats(msg): cid = msg.chat.id s = STATS.get(cid, {}) or {} downloads = s.get('downloads', 0) bytes_sent = s.get('bytes_sent', 0) last = s.get('last_activity') last_str = 'never' if not last else last mode = PREFS.get(cid, {}).get('mode', 'media') caption_on = PREFS.get(cid, {}).get('caption_on', True) reply = ( f"📊 Stats for this chat:\n" f"• Downloads: {downloads}\n" f"• Data sent: {round(bytes_sent / (1024*1024), 2)} MB\n" f"• Last activity: {last_str}\n" f"• Mode: {mode}\n" f"• Caption: {'on' if caption_on else 'off'}" ) bot.reply_to(msg, reply)
+START_TEXT = (
+    "👋 Send me a public Instagram post/reel/tv URL (single or multiple lines) and I’ll fetch the media.\n\n"
+    "Commands:\n"
+    "• /settings — quick toggles (mode, caption)\n"
+    "• /mode media|document — set default send mode\n"
+    "• /stats — show your usage stats\n\n"
+    "<i>Only download/share content you’re allowed to. Scraping may be restricted by Instagram's Terms.</i>"
+)
+
+
+def init_prefs(chat_id: int):
+    if PREFS.get(chat_id) is None:
+        PREFS.set(chat_id, {'mode': 'media', 'caption_on': True})
+
+
+@bot.message_handler(commands=['settings'])
+def cmd_settings(msg):
+    bot.reply_to(msg, "⚙️ Settings", reply_markup=settings_keyboard(msg.chat.id))
 
--------------------- Core handler (single or multiple URLs) --------------------
 
-@bot.message_handler(func=lambda m: bool(URL_RE.search(m.text or '') or SHORT_REDIR_RE.search(m.text or ''))) def handle_instagram(msg): chat_id = msg.chat.id user_id = msg.from_user.id
+def is_settings_callback(c) -> bool:
+    return bool(c.data and (c.data.startswith('toggle:') or c.data.startswith('clear:') or c.data.startswith('check:')))
 
-# Channel verification: if configured, require membership before proceeding
-if not user_is_member_of_channel(user_id):
-    ensure_channel_join_prompt(chat_id, user_id)
-    return
 
-if not rate_ok(chat_id):
-    bot.reply_to(msg, "⏳ Slow down a bit — too many requests. Try again in a minute.")
-    return
+def toggle_steps(cb):
+    chat_id = cb.message.chat.id
+    answer = yield Blocking(apply_setting, chat_id, cb.data)
+    if answer:
+        yield Call('answer_callback_query', cb.id, answer)
+    elif cb.data == 'check:joined':
+        # Re-check membership for the user who pressed the button (fresh, not cached)
+        user_id = cb.from_user.id
+        MEMBER_CACHE.invalidate(user_id)
+        if (yield from channel_member(user_id)):
+            yield Call('answer_callback_query', cb.id, "Thanks — membership confirmed ✅")
+            try:
+                yield Call('edit_message_text', "Thank you for joining! Use /start to begin.", chat_id, cb.message.message_id)
+            except Exception:
+                pass
+        else:
+            yield Call('answer_callback_query', cb.id, "Still not a member — please join the channel first.")
+    # refresh keyboard
+    try:
+        yield Call('edit_message_reply_markup', chat_id, cb.message.message_id, reply_markup=settings_keyboard(chat_id))
+    except Exception:
+        pass
 
-text = msg.text or ''
-urls = []
-# allow multiple URLs (newline-separated or space-separated)
-for line in re.split(r'[
 
-,;]+', text): u = sanitize_url(line) if u: urls.append(u) if not urls: bot.reply_to(msg, "Please send a valid Instagram URL.") return
+@bot.callback_query_handler(func=is_settings_callback)
+def on_toggle(cb):
+    run_steps(toggle_steps(cb))
+
+
+def apply_setting(chat_id: int, data: str) -> str | None:
+    """Apply a settings-keyboard button. Returns the callback answer, None if not a settings button."""
+    if data == 'toggle:mode':
+        cur = PREFS.get(chat_id, {}).get('mode', 'media')
+        new_mode = 'document' if cur == 'media' else 'media'
+        PREFS.update_subkey(chat_id, 'mode', new_mode)
+        return f"Mode → {new_mode}"
+    if data == 'toggle:caption':
+        cur = PREFS.get(chat_id, {}).get('caption_on', True)
+        PREFS.update_subkey(chat_id, 'caption_on', not cur)
+        return f"Caption → {'on' if not cur else 'off'}"
+    if data == 'toggle:passthrough':
+        cur = PREFS.get(chat_id, {}).get('passthrough', False)
+        PREFS.update_subkey(chat_id, 'passthrough', not cur)
+        return f"Passthrough → {'on (media mode only)' if not cur else 'off'}"
+    if data == 'clear:stats':
+        STATS.set(chat_id, {})
+        return "Stats cleared"
+    return None
+
+
+def mode_reply(chat_id: int, text: str) -> str:
+    """Handle /mode [media|document]; returns the reply."""
+    parts = text.strip().split(maxsplit=1)
+    if len(parts) == 1:
+        mode = PREFS.get(chat_id, {}).get('mode', 'media')
+        return f"Current mode: <b>{mode}</b>\nUse /mode media or /mode document."
+    choice = parts[1].strip().lower()
+    if choice not in ('media', 'document'):
+        return "Use: /mode media  or  /mode document"
+    PREFS.update_subkey(chat_id, 'mode', choice)
+    return f"✅ Mode updated to <b>{choice}</b>"
+
+
+@bot.message_handler(commands=['mode'])
+def cmd_mode(msg):
+    bot.reply_to(msg, mode_reply(msg.chat.id, msg.text))
+
+
+@bot.message_handler(commands=['stats'])
+def cmd_stats(msg):
+    bot.reply_to(msg, stats_text(msg.chat.id, msg.from_user.id))
+
+
+def stats_text(cid: int, user_id: int) -> str:
+    s = STATS.get(cid, {}) or {}
+    downloads = s.get('downloads', 0)
+    bytes_sent = s.get('bytes_sent', 0)
+    bytes_saved = s.get('bytes_saved', 0)
+    last = s.get('last_activity')
+    last_str = 'never' if not last else last
+    mode = PREFS.get(cid, {}).get('mode', 'media')
+    caption_on = PREFS.get(cid, {}).get('caption_on', True)
+    passthrough = PREFS.get(cid, {}).get('passthrough', False)
+    reply = (
+        f"📊 Stats for this chat:\n"
+        f"• Downloads: {downloads}\n"
+        f"• Data sent: {round(bytes_sent / (1024*1024), 2)} MB\n"
+        f"• Data saved by passthrough: {round(bytes_saved / (1024*1024), 2)} MB\n"
+        f"• Last activity: {last_str}\n"
+        f"• Mode: {mode}\n"
+        f"• Caption: {'on' if caption_on else 'off'}\n"
+        f"• Passthrough: {'on' if passthrough else 'off'}"
+    )
+    fc = FILE_CACHE.stats()
+    reply += (
+        f"\n\n♻️ Upload cache: {fc['entries']} posts, "
+        f"{fc['hits']} hits / {fc['misses']} misses ({round(fc['hit_rate'] * 100, 1)}%)"
+    )
+    if CHANNEL_USERNAME or CHANNEL_ID:
+        mc = MEMBER_CACHE.stats()
+        reply += (
+            f"\n👥 Membership cache: {mc['entries']} users, "
+            f"{mc['hits']} hits / {mc['misses']} misses ({round(mc['hit_rate'] * 100, 1)}%), "
+            f"{mc['coalesced']} coalesced"
+        )
+    if OWNER_ID and str(user_id) == str(OWNER_ID):
+        reply += "\n\n" + METRICS.summary()
+        reply += "\n🔐 IG sessions: " + ", ".join(
+            f"#{h['slot']} " + (f"cooling {h['cooldown']:.0f}s ({h['failures']} failures)" if h['cooldown']
+                                else 'busy' if h['in_use'] else 'ok')
+            for h in IG_POOL.health())
+    return reply
+
+
+# -------------------- Batch pipeline --------------------
+# Stage 1 runs on DOWNLOAD_POOL: fetch the post and build its collage, at most
+# PIPELINE_PREFETCH links ahead of the uploader. Stage 2 runs in the handler
+# thread and uploads finished items strictly in URL order, so item N uploads
+# while N+1.. are still downloading.
+
+DOWNLOAD_POOL = ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS, thread_name_prefix="ig-dl")
+METRICS.gauge('ig_queue_depth', lambda: DOWNLOAD_POOL._work_queue.qsize(), queue='download')
+METRICS.gauge('ig_inflight', lambda: IG_POOL.size - len(IG_POOL.idle), stage='ig_session')
+
+STAGE_LABELS = [
+    ('done', '✅', 'sent'),
+    ('uploading', '⬆️', 'uploading'),
+    ('ready', '📦', 'ready'),
+    ('downloading', '⬇️', 'downloading'),
+    ('resolving', '🔗', 'resolving'),
+    ('cached', '♻️', 'cached'),
+    ('queued', '⏳', 'queued'),
+    ('failed', '⚠️', 'failed'),
+]
+
+
+def prepare_media(url: str, set_stage=lambda stage: None) -> Dict[str, Any]:
+    """Download stage: fetch one post and build its collage."""
+    set_stage('downloading')
+    spool, meta = download_instagram_media(url)
+    files = list(spool.buffers)
+
+    # If multiple photos, create collage
+    photo_files = [b for b in files if b.kind == 'photo']
+    collage = None
+    if len(photo_files) > 1:
+        try:
+            data = build_collage(spool.shortcode, photo_files)
+            collage = spool.new_buffer(f"{spool.shortcode}_collage.jpg", 'photo')
+            collage.write(data)
+            collage.finish()
+        except Exception:
+            collage = None
+
+    set_stage('ready')
+    return {'spool': spool, 'files': files, 'meta': meta, 'collage': collage}
+
+
+def prepare_links(url: str) -> Dict[str, Any]:
+    """Passthrough counterpart of prepare_media: resolve the post and size its files, download nothing."""
+    shortcode = extract_shortcode(url)
+    sources, meta = resolve_post(shortcode)
+    if not sources:
+        raise RuntimeError("No downloadable media found for this URL.")
+    return {'links': [{'kind': kind, 'url': u, 'size': media_size(u)} for kind, u in sources], 'meta': meta}
+
+
+def link_fits(link: dict) -> bool:
+    """Is this file known to be small enough for Telegram to fetch by URL?"""
+    limit = TELEGRAM_URL_PHOTO_MAX if link['kind'] == 'photo' else TELEGRAM_URL_FILE_MAX
+    return link['size'] is not None and link['size'] <= limit
+
+
+def _release_prepared(prepared: Dict[str, Any] | None):
+    if prepared:
+        prepared['spool'].close()
+
+
+class DownloadFlights:
+    """Single-flight downloads keyed by shortcode.
+
+    join() attaches a job to the in-progress (or finished, still referenced)
+    download of its post, starting one only if there is none, so a link sent by many chats at once is fetched from Instagram
+    once. Every join() holds a reference on the shared result; release()
+    drops it and the spool is closed when the last holder lets go. A failed
+    download is shared with the jobs already waiting on it, but the next
+    join() starts a fresh attempt.
+    """
+
+    def __init__(self, start, close=None):
+        self.start = start  # (url, set_stage) -> concurrent.futures.Future of prepared media
+        self.close = close or _release_prepared  # frees a finished download's buffers / tmpdir
+        self.lock = threading.Lock()
+        self.flights: Dict[str, dict] = {}  # shortcode -> {'future', 'refs', 'jobs', 'stage'}
+        self.coalesced = 0
+
+    def _set_stage(self, flight: dict, stage: str):
+        with self.lock:
+            flight['stage'] = stage
+            for job in flight['jobs']:
+                job['stage'] = stage
+
+    def join(self, job: dict):
+        """Attach job to its post's download; sets job['flight'] and returns the shared future."""
+        shortcode = job['shortcode']
+        with self.lock:
+            flight = self.flights.get(shortcode)
+            fut = flight['future'] if flight else None
+            if fut is None or fut.cancelled() or (fut.done() and fut.exception() is not None):
+                flight = {'future': None, 'refs': 0, 'jobs': [], 'stage': 'queued'}
+                self.flights[shortcode] = flight
+                flight['future'] = self.start(job['url'], lambda stage: self._set_stage(flight, stage))
+            else:
+                self.coalesced += 1
+                METRICS.inc('ig_coalesced_total')
+            flight['refs'] += 1
+            flight['jobs'].append(job)
+            job['stage'] = flight['stage']
+        job['flight'] = flight
+        return flight['future']
+
+    def release(self, job: dict):
+        """Drop job's reference; the last one out closes the spool (or cancels a download not yet started)."""
+        flight = job.pop('flight', None)
+        if flight is None:
+            return
+        with self.lock:
+            flight['refs'] -= 1
+            flight['jobs'] = [j for j in flight['jobs'] if j is not job]
+            if flight['refs'] > 0:
+                return
+            shortcode = job['shortcode']
+            if self.flights.get(shortcode) is flight:
+                del self.flights[shortcode]
+        fut = flight['future']
+        if fut.cancel():
+            return
+        fut.add_done_callback(lambda f: self.close(f.result()) if not f.exception() else None)
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return {'active': len(self.flights), 'coalesced': self.coalesced}
+
+
+FLIGHTS = DownloadFlights(lambda url, set_stage: DOWNLOAD_POOL.submit(prepare_media, url, set_stage))
+
+
+def deliver_prepared(chat_id: int, mode: str, caption_on: bool, prepared: Dict[str, Any]):
+    """Steps: upload stage for a freshly downloaded post. Returns (items sent, bytes sent)."""
+    files = prepared['files']
+    meta = prepared['meta']
+    collage = prepared['collage']
+    caption = fmt_meta_caption(meta, include_body=caption_on)
+
+    # Extract hashtags
+    tags = extract_hashtags(meta.get('caption', ''))
+    tags_line = '\n\n' + ' '.join(tags) if tags else ''
+
+    sent_items: List[Dict[str, Any]] = []
+    sizes: List[int] = []
+    if mode == 'document':
+        # send caption first, then the files as document albums
+        yield Call('send_message', chat_id, caption + tags_line, disable_web_page_preview=True)
+        media = [{'kind': 'document', 'buffer': b} for b in files]
+        sent_items += yield from send_album(chat_id, media)
+    else:
+        # media mode
+        media = [{'kind': b.kind, 'buffer': b} for b in files]
+        if collage:
+            # send collage first with caption, then everything as albums
+            sent_items += yield from send_album(chat_id, [{'kind': 'photo', 'buffer': collage}], caption + tags_line)
+            sizes.append(collage.size)
+            sent_items += yield from send_album(chat_id, media)
+        else:
+            sent_items += yield from send_album(chat_id, media, caption + tags_line)
+    sizes += [b.size for b in files]
+    total_bytes = sum(size for size, item in zip(sizes, sent_items) if item['file_id'])
+
+    FILE_CACHE.put(meta['shortcode'], mode, sent_items, meta,
+                   fmt_meta_caption(meta, include_body=True) + tags_line, total_bytes)
+    return sum(1 for item in sent_items if item['file_id']), total_bytes
+
+
+def deliver_links(chat_id: int, caption_on: bool, prepared: Dict[str, Any]):
+    """Steps: upload stage in passthrough mode; Telegram fetches the CDN URLs itself.
+
+    Returns (items sent, bytes saved, indexes of the items Telegram refused),
+    or None if a file is over Telegram's URL limits and the post has to go
+    the download-and-upload way. Raises if Telegram refused every item.
+    """
+    links = prepared['links']
+    if not all(link_fits(link) for link in links):
+        return None
+    meta = prepared['meta']
+    tags = extract_hashtags(meta.get('caption', ''))
+    tags_line = '\n\n' + ' '.join(tags) if tags else ''
+    # no collage: it would need the photos downloaded here
+    sent_items = yield from send_album(chat_id, [{'kind': link['kind'], 'url': link['url']} for link in links],
+                                       fmt_meta_caption(meta, include_body=caption_on) + tags_line)
+    return links_sent(meta, links, sent_items, tags_line)
+
+
+def links_sent(meta: dict, links: List[dict], sent_items: List[dict], tags_line: str) -> Tuple[int, int, List[int]]:
+    refused = [i for i, item in enumerate(sent_items) if not item['file_id']]
+    saved = sum(link['size'] for link, item in zip(links, sent_items) if item['file_id'])
+    # media mode sends the same thing unless it would add a collage (2+ photos)
+    if not refused and sum(1 for link in links if link['kind'] == 'photo') < 2:
+        FILE_CACHE.put(meta['shortcode'], 'media', sent_items, meta,
+                       fmt_meta_caption(meta, include_body=True) + tags_line, saved)
+    return len(sent_items) - len(refused), saved, refused
+
+
+def deliver_refused(chat_id: int, prepared: Dict[str, Any], refused: List[int]):
+    """Steps: upload, from a finished download, the files Telegram would not fetch by URL."""
+    files = [prepared['files'][i] for i in refused if i < len(prepared['files'])]
+    sent = yield from send_album(chat_id, [{'kind': b.kind, 'buffer': b} for b in files])
+    return (sum(1 for item in sent if item['file_id']),
+            sum(b.size for b, item in zip(files, sent) if item['file_id']))
+
+
+def deliver_cached(chat_id: int, mode: str, caption_on: bool, entry: dict):
+    """Steps: upload stage for a FILE_CACHE hit. Returns (items sent, bytes sent)."""
+    meta = entry['meta']
+    if caption_on:
+        caption = entry['caption']
+    else:
+        tags = extract_hashtags(meta.get('caption', ''))
+        caption = fmt_meta_caption(meta, include_body=False) + ('\n\n' + ' '.join(tags) if tags else '')
+    return (yield from _send_cached(chat_id, entry, mode, caption)), entry['bytes']
+
+
+def _discard_job(job: dict, flights: DownloadFlights):
+    """Drop a job whose result will never be uploaded, releasing its share of the download."""
+    links = job.pop('links', None)
+    if links is not None:
+        links.cancel()
+    job['future'] = None
+    flights.release(job)
+
+
+def make_jobs(urls: List[str], mode: str) -> List[dict]:
+    jobs: List[dict] = []
+    for url in urls:
+        shortcode = extract_shortcode(url)
+        # Already uploaded this post in this mode? It will be re-sent by file_id.
+        cached = FILE_CACHE.get(shortcode, mode)
+        jobs.append({'url': url, 'shortcode': shortcode, 'cached': cached,
+                     'stage': 'cached' if cached else 'queued', 'future': None})
+    return jobs
+
+
+def record_result(chat_id: int, result: str, downloads: int, total_bytes: int, saved: int = 0):
+    METRICS.inc('ig_urls_total', result=result)
+    if downloads:
+        METRICS.inc('ig_items_sent_total', downloads)
+        METRICS.inc('ig_bytes_sent_total', total_bytes)
+        STATS.inc(chat_id, 'downloads', downloads)
+        STATS.inc(chat_id, 'bytes_sent', total_bytes)
+        if saved:
+            METRICS.inc('ig_bytes_saved_total', saved)
+            STATS.inc(chat_id, 'bytes_saved', saved)
+        STATS.update_subkey(chat_id, 'last_activity', datetime.utcnow().isoformat() + 'Z')
 
-notice = bot.reply_to(msg, f"Fetching {len(urls)} link(s)…")
 
-total_bytes = 0
-downloads = 0
-try:
-    for idx, url in enumerate(urls, start=1):
-        # progress edit
+def final_status(jobs: List[dict], errors: List[Exception]) -> str:
+    if not errors:
+        return "Done ✅"
+    if len(errors) == len(jobs):
+        return f"⚠️ Error: {html.escape(str(errors[0]))}"
+    return f"Done — {len(errors)} of {len(jobs)} link(s) failed.\n⚠️ {html.escape(str(errors[0]))}"
+
+
+def batch_status(jobs: List[dict], current: dict | None = None) -> str:
+    counts: Dict[str, int] = {}
+    for job in jobs:
+        counts[job['stage']] = counts.get(job['stage'], 0) + 1
+    parts = [f"{icon} {counts[stage]} {label}" for stage, icon, label in STAGE_LABELS if counts.get(stage)]
+    text = f"Fetching {len(jobs)} link(s)…\n" + "  ·  ".join(parts)
+    if current is not None:
+        text += f"\nNow: <code>{html.escape(current['url'])}</code>"
+    return text
+
+
+# -------------------- Core handler (single or multiple URLs) --------------------
+
+def has_instagram_url(m) -> bool:
+    return bool(URL_RE.search(m.text or '') or SHORT_REDIR_RE.search(m.text or ''))
+
+
+def parse_urls(text: str) -> List[str]:
+    urls = []
+    # allow multiple URLs (newline-separated or space-separated)
+    for line in re.split(r'[\s,;]+', text or ''):
+        u = sanitize_url(line)
+        if u:
+            urls.append(u)
+    return urls
+
+
+def queued_text(count: int, delay: float) -> str:
+    eta = f"~{round(delay)}s" if delay < 90 else f"~{round(delay / 60)} min"
+    return f"⏳ Queued — {count} link(s) will start in {eta}."
+
+
+DROPPED_TEXT = "⚠️ The bot restarted before your queued link(s) could start — please send them again."
+
+
+class BatchQueue:
+    """Batches held back by the per-chat rate limit until their slot comes up.
+
+    One thread keeps them in a heap by due time and hands each due batch to
+    dispatch(msg, urls, notice): telebot's worker pool when polling, the
+    webhook dispatcher under the chat's key in webhook mode. Queued batches
+    so run within the same thread budget (and per-chat order) as live
+    updates. dispatch must not block; when it returns False (queue full) the
+    batch is parked for RETRY_SEC and the chat's later batches wait behind
+    it. shutdown() tells every chat whose batch never started.
+    """
+
+    RETRY_SEC = 1.0
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.heap: List[tuple] = []  # (due, seq, msg, urls, notice)
+        self.seq = 0
+        self.parked: Dict[int, tuple] = {}  # chat_id -> (due, seq) of its refused batch
+        self.closed = False
+        self.dispatch = self._to_worker_pool
+        self.thread = threading.Thread(target=self._run, name="batch-queue", daemon=True)
+        self.thread.start()
+
+    @staticmethod
+    def _to_worker_pool(msg, urls: List[str], notice) -> bool:
+        bot.worker_pool.put(process_batch, msg, urls, notice)
+        return True
+
+    def push(self, delay: float, msg, urls: List[str], notice):
+        with self.cond:
+            if self.closed:
+                return self.dropped(msg, notice)
+            self.seq += 1
+            heapq.heappush(self.heap, (time.monotonic() + delay, self.seq, msg, urls, notice))
+            self.cond.notify()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.closed and (not self.heap or self.heap[0][0] > time.monotonic()):
+                    self.cond.wait(self.heap[0][0] - time.monotonic() if self.heap else None)
+                if self.closed:
+                    return
+                due, seq, msg, urls, notice = heapq.heappop(self.heap)
+                held = self.parked.get(msg.chat.id)
+                if held is not None and held[1] != seq:
+                    # an earlier batch of this chat is parked: stay behind it
+                    heapq.heappush(self.heap, (held[0], seq, msg, urls, notice))
+                    continue
+            try:
+                accepted = self.dispatch(msg, urls, notice)
+            except Exception:
+                accepted = False
+            with self.cond:
+                if accepted:
+                    self.parked.pop(msg.chat.id, None)
+                    continue
+                retry = (time.monotonic() + self.RETRY_SEC, seq)
+                self.parked[msg.chat.id] = retry
+                heapq.heappush(self.heap, (*retry, msg, urls, notice))
+
+    @staticmethod
+    def dropped(msg, notice):
         try:
-            bot.edit_message_text(f"Fetching {idx}/{len(urls)}: <code>{html.escape(url)}</code>", chat_id, notice.message_id)
+            bot.edit_message_text(DROPPED_TEXT, msg.chat.id, notice.message_id)
         except Exception:
             pass
 
-        tmpdir, files, meta = download_instagram_media(url, IG_USER, IG_PASS)
-        mode = PREFS.get(chat_id, {}).get('mode', 'media')
-        caption_on = PREFS.get(chat_id, {}).get('caption_on', True)
-        caption = fmt_meta_caption(meta, include_body=caption_on)
+    def depth(self) -> int:
+        with self.cond:
+            return len(self.heap)
+
+    def shutdown(self):
+        with self.cond:
+            self.closed = True
+            pending, self.heap = self.heap, []
+            self.parked.clear()
+            self.cond.notify()
+        for _, _, msg, _, notice in pending:
+            self.dropped(msg, notice)
+
+
+BATCHES = BatchQueue()
+METRICS.gauge('ig_queue_depth', BATCHES.depth, queue='rate_limited')
+atexit.register(BATCHES.shutdown)
+
+
+def intake_steps(msg):
+    """Front half of the URL handler: membership, rate limit, parsing, the first reply.
+
+    Returns (urls, delay, notice) for a batch to run now (delay 0) or once
+    its rate-limit slot comes up, or None if the message was answered here.
+    """
+    chat_id = msg.chat.id
+    user_id = msg.from_user.id
+
+    # Channel verification: if configured, require membership before proceeding
+    if not (yield from channel_member(user_id)):
+        yield from ensure_channel_join_prompt(chat_id, user_id)
+        return None
+
+    delay = rate_reserve(chat_id)
+    if delay is None:
+        METRICS.inc('ig_rate_limited_total')
+        yield Call('reply_to', msg, "⏳ Slow down a bit — too many requests. Try again in a few minutes.")
+        return None
+
+    urls = parse_urls(msg.text)
+    if not urls:
+        yield Call('reply_to', msg, "Please send a valid Instagram URL.")
+        return None
+
+    if delay > 0:
+        # over the per-chat rate: queue the batch instead of refusing it
+        METRICS.inc('ig_queued_total')
+        return urls, delay, (yield Call('reply_to', msg, queued_text(len(urls), delay)))
+    return urls, 0.0, (yield Call('reply_to', msg, f"Fetching {len(urls)} link(s)…"))
+
+
+@bot.message_handler(func=has_instagram_url)
+def handle_instagram(msg):
+    accepted = run_steps(intake_steps(msg))
+    if accepted is None:
+        return
+    urls, delay, notice = accepted
+    if delay > 0:
+        BATCHES.push(delay, msg, urls, notice)
+        return
+    process_batch(msg, urls, notice)
+
+
+def process_batch(msg, urls: List[str], notice):
+    """Download and deliver a batch of links on the threaded engine."""
+    run_steps(batch_steps(msg, urls, notice, FLIGHTS, lambda url: DOWNLOAD_POOL.submit(prepare_links, url)))
+
+
+def batch_steps(msg, urls: List[str], notice, flights: DownloadFlights, resolve_links):
+    """Steps: download and deliver a batch of links, reporting progress in the notice message.
+
+    flights is the engine's DownloadFlights; resolve_links(url) returns a
+    future of prepare_links(url) for passthrough chats.
+    """
+    chat_id = msg.chat.id
+    mode = PREFS.get(chat_id, {}).get('mode', 'media')
+    caption_on = PREFS.get(chat_id, {}).get('caption_on', True)
+    passthrough = mode == 'media' and PREFS.get(chat_id, {}).get('passthrough', False)
+    jobs = make_jobs(urls, mode)
+
+    def submit_ahead(start: int):
+        for job in jobs[start:start + PIPELINE_PREFETCH]:
+            if job['stage'] == 'queued' and job['future'] is None:
+                if passthrough:
+                    job['stage'] = 'resolving'
+                    job['links'] = resolve_links(job['url'])
+                else:
+                    job['future'] = flights.join(job)
 
-        # Extract hashtags
-        tags = extract_hashtags(meta.get('caption', ''))
-        tags_line = '
+    last_status = None
 
-' + ' '.join(tags) if tags else ''
+    def show_status(current: dict | None = None):
+        nonlocal last_status
+        status = batch_status(jobs, current)
+        if status == last_status or SEND.eta(chat_id) > 0:
+            return  # unchanged, or the chat is out of send budget: don't spend it on progress
+        last_status = status
+        try:
+            yield Call('edit_message_text', status, chat_id, notice.message_id)
+        except Exception:
+            pass
 
-# If multiple photos, create collage
-        photo_files = [f for f in files if f.lower().endswith(('.jpg', '.jpeg', '.png'))]
-        collage_path = None
-        if len(photo_files) > 1:
+    errors: List[Exception] = []
+    try:
+        with METRICS.stage('request'):
+            for idx, job in enumerate(jobs):
+                submit_ahead(idx)
+                yield from show_status(job)
+
+                downloads = 0
+                total_bytes = 0
+                saved = 0
+                refused = None
+                result = 'failed'
+                try:
+                    if job['cached']:
+                        job['stage'] = 'uploading'
+                        try:
+                            with METRICS.stage('upload'), SEND.priority(SEND.BULK):
+                                downloads, total_bytes = yield from deliver_cached(chat_id, mode, caption_on, job['cached'])
+                            result = 'cached'
+                        except API_ERRORS:
+                            # file_id no longer valid for us; drop it and fetch fresh
+                            FILE_CACHE.invalidate(job['shortcode'], mode)
+                            job['cached'] = None
+                            job['future'] = flights.join(job)
+
+                    if job.get('links'):
+                        linked = None
+                        try:
+                            links = yield Wait(job.pop('links'))
+                            job['stage'] = 'uploading'
+                            yield from show_status(job)
+                            with METRICS.stage('upload'), SEND.priority(SEND.BULK):
+                                linked = yield from deliver_links(chat_id, caption_on, links)
+                        except API_ERRORS:
+                            pass  # Telegram could not fetch any of it
+                        if linked:
+                            downloads, saved, refused = linked
+                            result = 'linked'
+                        if not linked or refused:
+                            # too large or refused: download and upload as usual
+                            job['future'] = flights.join(job)
+
+                    if job['future'] is not None:
+                        try:
+                            prepared = yield Wait(job['future'])
+                            job['future'] = None
+                            job['stage'] = 'uploading'
+                            yield from show_status(job)
+                            if refused:
+                                with METRICS.stage('upload'), SEND.priority(SEND.BULK):
+                                    uploaded, total_bytes = yield from deliver_refused(chat_id, prepared, refused)
+                                downloads += uploaded
+                            else:
+                                # a chat sharing this download may have uploaded it meanwhile
+                                cached = FILE_CACHE.get(job['shortcode'], mode, count=False)
+                                if cached:
+                                    try:
+                                        with METRICS.stage('upload'), SEND.priority(SEND.BULK):
+                                            downloads, total_bytes = yield from deliver_cached(
+                                                chat_id, mode, caption_on, cached)
+                                        result = 'cached'
+                                    except API_ERRORS:
+                                        FILE_CACHE.invalidate(job['shortcode'], mode)
+                                if result != 'cached':
+                                    with METRICS.stage('upload'), SEND.priority(SEND.BULK):
+                                        downloads, total_bytes = yield from deliver_prepared(
+                                            chat_id, mode, caption_on, prepared)
+                                    result = 'sent'
+                        finally:
+                            # drop our share of the buffers / spilled tmpdir
+                            flights.release(job)
+                    job['stage'] = 'done'
+                except Exception as e:
+                    job['stage'] = 'failed'
+                    job['future'] = None
+                    errors.append(e)
+                    METRICS.error('pipeline', e)
+                # update stats per url
+                record_result(chat_id, result, downloads, total_bytes, saved)
+
+        yield Call('edit_message_text', final_status(jobs, errors), chat_id, notice.message_id)
+    except Exception as e:
+        try:
+            yield Call('edit_message_text', f"⚠️ Error: {html.escape(str(e))}", chat_id, notice.message_id)
+        except Exception:
+            yield Call('reply_to', msg, f"⚠️ Error: {html.escape(str(e))}")
+    finally:
+        # don't leave prefetched downloads behind if the batch was cut short
+        for job in jobs:
+            _discard_job(job, flights)
+
+
+# -------------------- Webhook ingestion --------------------
+# BOT_MODE=webhook: Telegram POSTs updates to WEBHOOK_PATH. The HTTP handler
+# only parses and enqueues them; UpdateDispatcher runs them on
+# WEBHOOK_WORKERS threads, one update at a time per chat so a chat's
+# messages keep their order while other chats proceed in parallel.
+
+class UpdateDispatcher:
+    """Bounded multi-queue: per-key FIFO, keys served round-robin by a worker pool."""
+
+    def __init__(self, workers: int, max_pending: int, handler):
+        self.handler = handler
+        self.max_pending = max_pending
+        self.cond = threading.Condition()
+        self.pending: Dict[Any, deque] = {}
+        self.ready: deque = deque()  # keys with queued work and no worker on them
+        self.active: set = set()
+        self.count = 0  # queued, not yet picked up
+        self.closed = False
+        self.threads = [threading.Thread(target=self._worker, name=f"wh-{i}", daemon=True)
+                        for i in range(max(1, workers))]
+        for t in self.threads:
+            t.start()
+
+    def submit(self, key, item, timeout: float) -> bool:
+        """Queue item under key; blocks up to timeout while full. False = rejected."""
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while self.count >= self.max_pending and not self.closed:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.cond.wait(remaining)
+            if self.closed:
+                return False
+            q = self.pending.get(key)
+            if q is None:
+                q = self.pending[key] = deque()
+                if key not in self.active:
+                    self.ready.append(key)
+            q.append(item)
+            self.count += 1
+            self.cond.notify_all()
+            return True
+
+    def _worker(self):
+        while True:
+            with self.cond:
+                while not self.ready and not (self.closed and not self.count):
+                    self.cond.wait()
+                if not self.ready:
+                    return  # closed and drained
+                key = self.ready.popleft()
+                item = self.pending[key].popleft()
+                self.count -= 1
+                self.active.add(key)
+                self.cond.notify_all()
             try:
-                collage_path = os.path.join(tmpdir, 'collage.jpg')
-                create_collage_image(photo_files, collage_path)
+                self.handler(item)
             except Exception:
-                collage_path = None
-
-        # Send
-        if mode == 'document':
-            # send caption first
-            bot.send_message(chat_id, caption + tags_line, disable_web_page_preview=True)
-            for path in files[:TELEGRAM_ALBUM_MAX]:
-                with open(path, 'rb') as fh:
-                    bot.send_document(chat_id, fh)
-                    fh.seek(0, os.SEEK_END)
-                    total_bytes += fh.tell()
-                    downloads += 1
-        else:
-            # media mode
-            if collage_path:
-                # send collage first with caption
-                with open(collage_path, 'rb') as fh:
-                    bot.send_photo(chat_id, fh, caption=caption + tags_line)
-                    fh.seek(0, os.SEEK_END)
-                    total_bytes += fh.tell()
-                    downloads += 1
-                # then send rest as media group (up to TELEGRAM_ALBUM_MAX)
-                media_items = []
-                count = 0
-                for path in files[:TELEGRAM_ALBUM_MAX]:
-                    if path == collage_path:
-                        continue
-                    if path.lower().endswith('.mp4'):
-                        with open(path, 'rb') as fh:
-                            bot.send_video(chat_id, fh)
-                            fh.seek(0, os.SEEK_END)
-                            total_bytes += fh.tell()
-                            downloads += 1
+                pass
+            finally:
+                with self.cond:
+                    self.active.discard(key)
+                    if self.pending.get(key):
+                        self.ready.append(key)
                     else:
-                        with open(path, 'rb') as fh:
-                            bot.send_photo(chat_id, fh)
-                            fh.seek(0, os.SEEK_END)
-                            total_bytes += fh.tell()
-                            downloads += 1
-                    count += 1
-                    if count >= TELEGRAM_ALBUM_MAX:
-                        break
-            else:
-                # no collage
-                if len(files) == 1:
-                    path = files[0]
-                    with open(path, 'rb') as fh:
-                        if path.lower().endswith('.mp4'):
-                            bot.send_video(chat_id, fh, caption=caption + tags_line)
-                        else:
-                            bot.send_photo(chat_id, fh, caption=caption + tags_line)
-                        fh.seek(0, os.SEEK_END)
-                        total_bytes += fh.tell()
-                        downloads += 1
-                else:
-                    # multiple -> try to send media_group
-                    media_group = []
-                    sent_count = 0
-                    for path in files[:TELEGRAM_ALBUM_MAX]:
-                        if path.lower().endswith('.mp4'):
-                            with open(path, 'rb') as fh:
-                                bot.send_video(chat_id, fh)
-                                fh.seek(0, os.SEEK_END)
-                                total_bytes += fh.tell()
-                                downloads += 1
-                        else:
-                            with open(path, 'rb') as fh:
-                                bot.send_photo(chat_id, fh)
-                                fh.seek(0, os.SEEK_END)
-                                total_bytes += fh.tell()
-                                downloads += 1
-                        sent_count += 1
-                        if sent_count >= TELEGRAM_ALBUM_MAX:
-                            break
-
-        # update stats per url
-        STATS.inc(chat_id, 'downloads', downloads)
-        STATS.inc(chat_id, 'bytes_sent', total_bytes)
-        STATS.update_subkey(chat_id, 'last_activity', datetime.utcnow().isoformat() + 'Z')
+                        self.pending.pop(key, None)
+                    self.cond.notify_all()
+
+    def depth(self) -> int:
+        with self.cond:
+            return self.count
+
+    def shutdown(self, timeout: float) -> bool:
+        """Stop accepting, let workers finish what is queued. True if fully drained."""
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        deadline = time.monotonic() + timeout
+        for t in self.threads:
+            t.join(max(0.0, deadline - time.monotonic()))
+        return not any(t.is_alive() for t in self.threads)
+
+
+def _update_key(update) -> Any:
+    """Ordering key: the chat an update belongs to."""
+    if update.message is not None:
+        return update.message.chat.id
+    if update.edited_message is not None:
+        return update.edited_message.chat.id
+    if update.callback_query is not None and update.callback_query.message is not None:
+        return update.callback_query.message.chat.id
+    return ('update', update.update_id)
+
+
+def _process_update(item):
+    if callable(item):
+        item()  # a rate-limited batch handed back by BATCHES
+    else:
+        bot.process_new_updates([item])
+
+
+class _WebhookHandler(BaseHTTPRequestHandler):
+    dispatcher: UpdateDispatcher = None
+
+    def _reply(self, code: int, headers: Dict[str, str] = None):
+        self.send_response(code)
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_POST(self):
+        if self.path.split('?')[0].rstrip('/') != '/' + WEBHOOK_PATH.strip('/'):
+            return self._reply(404)
+        token = self.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if not hmac.compare_digest(token.encode('utf-8', 'replace'), WEBHOOK_SECRET.encode()):
+            return self._reply(403)
+        try:
+            body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+            update = telebot.types.Update.de_json(body.decode('utf-8'))
+        except Exception:
+            return self._reply(400)
+        if not self.dispatcher.submit(_update_key(update), update, WEBHOOK_ENQUEUE_TIMEOUT):
+            # queue full (or draining): Telegram redelivers on non-2xx
+            return self._reply(503, {'Retry-After': '1'})
+        self._reply(200)
+
+    def log_message(self, format, *args):
+        pass
 
-        # cleanup this tmpdir
-        if os.path.isdir(tmpdir):
-            shutil.rmtree(tmpdir, ignore_errors=True)
 
-    bot.edit_message_text("Done ✅", chat_id, notice.message_id)
-except Exception as e:
+def run_webhook():
+    if not WEBHOOK_SECRET:
+        # without it anyone who can reach the port can forge updates (any chat_id, from.id == OWNER_ID)
+        raise SystemExit("BOT_MODE=webhook needs WEBHOOK_SECRET=<random [A-Za-z0-9_-] string>")
+    # handlers run inline in our dispatcher workers, not telebot's thread pool
+    bot.threaded = False
+    dispatcher = UpdateDispatcher(WEBHOOK_WORKERS, WEBHOOK_QUEUE_MAX, _process_update)
+    _WebhookHandler.dispatcher = dispatcher
+    METRICS.gauge('ig_queue_depth', dispatcher.depth, queue='webhook')
+
+    def requeue(msg, urls, notice) -> bool:
+        # behind the chat's other updates, so per-chat order holds; never wait
+        # here, a full queue would stall every other chat's due batch
+        return dispatcher.submit(msg.chat.id, lambda: process_batch(msg, urls, notice), 0)
+
+    BATCHES.dispatch = requeue
+    server = ThreadingHTTPServer((WEBHOOK_LISTEN, WEBHOOK_PORT), _WebhookHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="wh-http", daemon=True).start()
+
+    if WEBHOOK_URL:
+        bot.set_webhook(url=WEBHOOK_URL.rstrip('/') + '/' + WEBHOOK_PATH.strip('/'),
+                        secret_token=WEBHOOK_SECRET,
+                        max_connections=WEBHOOK_WORKERS,
+                        drop_pending_updates=False)
+    print(f'Webhook listening on {WEBHOOK_LISTEN}:{server.server_port}/{WEBHOOK_PATH.strip("/")}')
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    signal.signal(signal.SIGINT, lambda *_: stop.set())
+    while not stop.wait(1):
+        pass
+
+    print('Draining...')
+    server.shutdown()
+    BATCHES.shutdown()
+    drained = dispatcher.shutdown(WEBHOOK_DRAIN_TIMEOUT)
+    print('Stopped' if drained else f'Stopped with {dispatcher.depth()} update(s) undrained')
+
+
+# -------------------- Asyncio engine (BOT_ENGINE=async) --------------------
+# The same commands and URL handler on AsyncTeleBot. Handlers are coroutines
+# that drive the shared steps with arun_steps(), so a chat waiting on
+# Instagram or an upload costs a task, not a thread. What is engine-specific
+# lives here: media is fetched over one pooled aiohttp session, Instaloader
+# lookups and collage rendering run in executors. Nothing that touches disk
+# or SQLite runs on the loop: spills go through awrite(), spilled spools are
+# removed on DOWNLOAD_POOL and PREFS writes (write-through) are Blocking steps. Stores, caches,
+# DownloadFlights, SEND budgets and METRICS are the same objects the threaded
+# engine uses.
+
+ABOT = None  # AsyncTeleBot, set by run_async()
+ASESSION = None  # aiohttp.ClientSession for CDN downloads
+AFLIGHTS: DownloadFlights | None = None
+_ADOWNLOADS: asyncio.Semaphore | None = None
+_RESOLVE_POOL: ThreadPoolExecutor | None = None
+_AQUEUED: set = set()  # handler tasks sleeping until their rate-limit slot
+
+
+async def awrite(buf: MediaBuffer, data: bytes):
+    """buf.write() from the loop: in-memory appends inline; spilling (mkdtemp,
+    quota reaping, file writes) in a worker thread."""
+    if buf.in_memory(len(data)):
+        buf.write(data)
+    else:
+        await asyncio.to_thread(buf.write, data)
+
+
+async def afinish(buf: MediaBuffer):
+    if buf.path is None:
+        buf.finish()
+    else:
+        await asyncio.to_thread(buf.finish)
+
+
+def _aclose_prepared(prepared: Dict[str, Any] | None):
+    """_release_prepared for AFLIGHTS: removing a spilled spool's tmpdir runs on DOWNLOAD_POOL, not the loop."""
+    if prepared and prepared['spool'].tmpdir:
+        DOWNLOAD_POOL.submit(_release_prepared, prepared)
+    else:
+        _release_prepared(prepared)
+
+
+async def afetch_into(buf: MediaBuffer, url: str):
+    async with ASESSION.get(url) as resp:
+        resp.raise_for_status()
+        async for chunk in resp.content.iter_chunked(256 * 1024):
+            await awrite(buf, chunk)
+    await afinish(buf)
+
+
+async def aprepare_media(url: str, set_stage=lambda stage: None) -> Dict[str, Any]:
+    """prepare_media for the asyncio engine; a post's files download concurrently."""
+    async with _ADOWNLOADS:
+        set_stage('downloading')
+        shortcode = extract_shortcode(url)
+        sources, meta = await asyncio.get_running_loop().run_in_executor(_RESOLVE_POOL, resolve_post, shortcode)
+        spool = MediaSpool(shortcode)
+        try:
+            bufs = [spool.new_buffer(f"{shortcode}_{idx}.{'mp4' if kind == 'video' else 'jpg'}", kind)
+                    for idx, (kind, _) in enumerate(sources, start=1)]
+            with METRICS.stage('download'):
+                # let every fetch finish before raising so none writes into a closed spool
+                results = await asyncio.gather(*(afetch_into(b, u) for b, (_, u) in zip(bufs, sources)),
+                                               return_exceptions=True)
+                for r in results:
+                    if isinstance(r, BaseException):
+                        raise r
+            if not bufs:
+                raise RuntimeError("No downloadable media found for this URL.")
+            files = list(bufs)
+
+            collage = None
+            photo_files = [b for b in files if b.kind == 'photo']
+            if len(photo_files) > 1:
+                try:
+                    data = await asyncio.to_thread(build_collage, shortcode, photo_files)
+                    collage = spool.new_buffer(f"{shortcode}_collage.jpg", 'photo')
+                    await awrite(collage, data)
+                    await afinish(collage)
+                except Exception:
+                    collage = None
+        except BaseException:
+            _aclose_prepared({'spool': spool})
+            raise
+    set_stage('ready')
+    return {'spool': spool, 'files': files, 'meta': meta, 'collage': collage}
+
+
+async def amedia_size(url: str) -> int | None:
     try:
-        bot.edit_message_text(f"⚠️ Error: {html.escape(str(e))}", chat_id, notice.message_id)
+        async with ASESSION.head(url, allow_redirects=True) as resp:
+            resp.raise_for_status()
+            return int(resp.headers['Content-Length'])
     except Exception:
-        bot.reply_to(msg, f"⚠️ Error: {html.escape(str(e))}")
-finally:
-    # ensure any leftover tmpdirs from partial runs are cleaned below by cleaner
-    pass
+        return None
+
 
--------------------- Start polling --------------------
+async def aprepare_links(url: str) -> Dict[str, Any]:
+    """prepare_links for the asyncio engine; the files are sized concurrently."""
+    shortcode = extract_shortcode(url)
+    sources, meta = await asyncio.get_running_loop().run_in_executor(_RESOLVE_POOL, resolve_post, shortcode)
+    if not sources:
+        raise RuntimeError("No downloadable media found for this URL.")
+    sizes = await asyncio.gather(*(amedia_size(u) for _, u in sources))
+    return {'links': [{'kind': kind, 'url': u, 'size': n} for (kind, u), n in zip(sources, sizes)], 'meta': meta}
 
-if name == 'main': print('Bot starting...') bot.infinity_polling(skip_pending=True)
+
+async def acmd_start(msg):
+    await arun_steps(start_steps(msg))
+
+
+async def acmd_settings(msg):
+    await ABOT.reply_to(msg, "⚙️ Settings", reply_markup=settings_keyboard(msg.chat.id))
+
+
+async def aon_toggle(cb):
+    await arun_steps(toggle_steps(cb))
+
+
+async def acmd_mode(msg):
+    # mode_reply may write PREFS (write-through)
+    await ABOT.reply_to(msg, await asyncio.to_thread(mode_reply, msg.chat.id, msg.text))
+
+
+async def acmd_stats(msg):
+    await ABOT.reply_to(msg, stats_text(msg.chat.id, msg.from_user.id))
+
+
+async def ahandle_instagram(msg):
+    accepted = await arun_steps(intake_steps(msg))
+    if accepted is None:
+        return
+    urls, delay, notice = accepted
+    if delay > 0:
+        task = asyncio.current_task()
+        _AQUEUED.add(task)
+        try:
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            # shutting down before the slot came up
+            try:
+                await ABOT.edit_message_text(DROPPED_TEXT, msg.chat.id, notice.message_id)
+            except Exception:
+                pass
+            raise
+        finally:
+            _AQUEUED.discard(task)
+    await aprocess_batch(msg, urls, notice)
+
+
+async def aprocess_batch(msg, urls: List[str], notice):
+    """process_batch for the asyncio engine."""
+    await arun_steps(batch_steps(msg, urls, notice, AFLIGHTS,
+                                 lambda url: asyncio.ensure_future(aprepare_links(url))))
+
+
+def _install_async_sender():
+    """Route AsyncTeleBot requests through SEND, like _send_request does for the threaded bot."""
+    process_request = asyncio_helper._process_request
+
+    async def send_request(token, url, method='get', params=None, files=None, **kwargs):
+        throttled = url.startswith(SEND_METHOD_PREFIXES)
+        chat_id = (params or {}).get('chat_id')
+        cost = _send_cost(url, params)
+        for attempt in range(SEND_MAX_RETRIES + 1):
+            if throttled:
+                METRICS.observe('send_wait', await SEND.acquire_async(chat_id, cost))
+            if attempt:
+                _rewind(files)
+            try:
+                # _process_request consumes params, so each attempt gets a copy
+                return await process_request(token, url, method, dict(params) if params else params, files, **kwargs)
+            except asyncio_helper.ApiTelegramException as e:
+                if e.error_code != 429 or attempt == SEND_MAX_RETRIES:
+                    raise
+                retry_after = float((e.result_json.get('parameters') or {}).get('retry_after', 1))
+            METRICS.inc('ig_flood_waits_total', method=url)
+            if throttled:
+                SEND.backoff(chat_id, retry_after)
+            else:
+                await asyncio.sleep(retry_after)
+
+    asyncio_helper._process_request = send_request
+
+
+def setup_async():
+    """Create ABOT and register the async handlers (no event loop needed yet)."""
+    global ABOT, _RESOLVE_POOL
+    if aiohttp is None:
+        raise SystemExit("BOT_ENGINE=async needs aiohttp: pip install aiohttp")
+    if TELEGRAM_API_URL:
+        asyncio_helper.API_URL = TELEGRAM_API_URL
+    asyncio_helper.REQUEST_LIMIT = ASYNC_HTTP_LIMIT
+    _install_async_sender()
+
+    ABOT = AsyncTeleBot(BOT_TOKEN, parse_mode="HTML")
+    ABOT.register_message_handler(acmd_start, commands=['start', 'help'])
+    ABOT.register_message_handler(acmd_settings, commands=['settings'])
+    ABOT.register_callback_query_handler(aon_toggle, func=is_settings_callback)
+    ABOT.register_message_handler(acmd_mode, commands=['mode'])
+    ABOT.register_message_handler(acmd_stats, commands=['stats'])
+    ABOT.register_message_handler(ahandle_instagram, func=has_instagram_url)
+    _RESOLVE_POOL = ThreadPoolExecutor(max_workers=max(1, IG_POOL_SIZE), thread_name_prefix="ig-resolve")
+
+
+async def astart():
+    """Create the loop-bound pieces: download session, semaphore and AFLIGHTS."""
+    global ASESSION, AFLIGHTS, _ADOWNLOADS
+    loop = asyncio.get_running_loop()
+    _ADOWNLOADS = asyncio.Semaphore(ASYNC_DOWNLOADS)
+    AFLIGHTS = DownloadFlights(lambda url, set_stage: asyncio.run_coroutine_threadsafe(
+        aprepare_media(url, set_stage), loop), close=_aclose_prepared)
+    ASESSION = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=ASYNC_HTTP_LIMIT, limit_per_host=ASYNC_HTTP_LIMIT),
+        timeout=aiohttp.ClientTimeout(sock_connect=HTTP_TIMEOUT, sock_read=HTTP_TIMEOUT),
+        headers={'User-Agent': HTTP.headers['User-Agent']})
+
+
+async def astop():
+    await ASESSION.close()
+    await ABOT.close_session()
+
+
+def run_async():
+    setup_async()
+
+    async def main():
+        await astart()
+        polling = asyncio.ensure_future(ABOT.infinity_polling(skip_pending=True))
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, polling.cancel)
+        try:
+            await polling
+        except asyncio.CancelledError:
+            pass
+        # polling has stopped; tell queued batches they won't run, let running ones finish
+        for task in list(_AQUEUED):
+            task.cancel()
+        pending = asyncio.all_tasks() - {asyncio.current_task()}
+        if pending:
+            await asyncio.wait(pending, timeout=WEBHOOK_DRAIN_TIMEOUT)
+        await astop()
+
+    asyncio.run(main())
+    print('Stopped')
+
+
+# -------------------- Start polling --------------------
+
+if __name__ == '__main__':
+    print('Bot starting...')
+    IG_POOL.warm()
+    start_metrics_server()
+    if BOT_ENGINE == 'async':
+        run_async()
+    elif BOT_MODE == 'webhook':
+        run_webhook()
+    else:
+        # turn SIGTERM into a normal exit so atexit flushes buffered stats
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+        bot.infinity_polling(skip_pending=True)
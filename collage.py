@@ -0,0 +1,66 @@
+"""
+Collage rendering for bot.py.
+
+Pure image code with no import-time side effects, so it can be imported (and
+run in the collage worker processes) without any of the bot's clients,
+threads or database handles.
+"""
+import io
+from typing import List, Any
+
+from PIL import Image
+
+
+def create_collage_image(image_paths: List[Any], out_path: Any, size: int = 800) -> Any:
+    """Create a square collage (up to 4 images -> 2x2). Returns path to saved image.
+    Inputs and output may be paths or file objects.
+
+    Each tile is decoded at reduced scale (JPEG draft mode picks the smallest
+    DCT scale still >= the tile) and pasted before the next one is opened,
+    so no full-resolution bitmap or extra copy is held.
+    """
+    sources = image_paths[:4]
+    n = len(sources)
+    if n == 0:
+        raise ValueError("No images to make collage")
+
+    # decide grid
+    grid = (1, 1)
+    if n == 1:
+        grid = (1, 1)
+    elif n == 2:
+        grid = (2, 1)
+    else:
+        grid = (2, 2)
+
+    cols, rows = grid
+    thumb_w = size // cols
+    thumb_h = size // rows
+
+    new_im = Image.new('RGB', (thumb_w * cols, thumb_h * rows), (255, 255, 255))
+
+    i = 0
+    for r in range(rows):
+        for c in range(cols):
+            if i >= n:
+                break
+            with Image.open(sources[i]) as img:
+                img.draft('RGB', (thumb_w, thumb_h))
+                # reducing_gap lets thumbnail() use fast integer reduce() before LANCZOS
+                img.thumbnail((thumb_w, thumb_h), Image.Resampling.LANCZOS, reducing_gap=2.0)
+                tile = img if img.mode == 'RGB' else img.convert('RGB')
+                # center paste
+                x = c * thumb_w + (thumb_w - tile.width) // 2
+                y = r * thumb_h + (thumb_h - tile.height) // 2
+                new_im.paste(tile, (x, y))
+            i += 1
+
+    new_im.save(out_path, format='JPEG', quality=85)
+    return out_path
+
+
+def render_collage(sources: List[Any], size: int = 800) -> bytes:
+    """Process-pool entry point: sources are paths or raw image bytes; returns JPEG bytes."""
+    out = io.BytesIO()
+    create_collage_image([io.BytesIO(s) if isinstance(s, bytes) else s for s in sources], out, size)
+    return out.getvalue()
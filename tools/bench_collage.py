@@ -0,0 +1,124 @@
+"""
+Collage micro-benchmark: legacy full-decode collage vs create_collage_image.
+
+Each variant runs in its own subprocess so peak RSS is not shared. Reported
+RSS is the growth of VmHWM over the post-import baseline. VmHWM restarts at
+exec; ru_maxrss would carry over the parent's peak from generating the images.
+
+Run:
+    python tools/bench_collage.py [--images 4] [--width 3024] [--height 4032] [--rounds 5]
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+import tempfile
+from typing import List
+
+from PIL import Image
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def legacy_collage(image_paths: List[str], out_path: str, size: int = 800) -> str:
+    """create_collage_image as it was before draft decoding (kept for comparison)."""
+    imgs = [Image.open(p).convert("RGB") for p in image_paths[:4]]
+    n = len(imgs)
+    cols, rows = (1, 1) if n == 1 else (2, 1) if n == 2 else (2, 2)
+    thumb_w = size // cols
+    thumb_h = size // rows
+    new_im = Image.new('RGB', (thumb_w * cols, thumb_h * rows), (255, 255, 255))
+    i = 0
+    for r in range(rows):
+        for c in range(cols):
+            if i >= n:
+                break
+            img = imgs[i].copy()
+            img.thumbnail((thumb_w, thumb_h), Image.Resampling.LANCZOS)
+            x = c * thumb_w + (thumb_w - img.width) // 2
+            y = r * thumb_h + (thumb_h - img.height) // 2
+            new_im.paste(img, (x, y))
+            i += 1
+    new_im.save(out_path, format='JPEG', quality=85)
+    for im in imgs:
+        im.close()
+    return out_path
+
+
+def make_images(workdir: str, count: int, width: int, height: int) -> List[str]:
+    paths = []
+    for i in range(count):
+        # gradient + noise compresses like a real photo rather than a flat fill
+        im = Image.linear_gradient('L').resize((width, height)).convert('RGB')
+        im = Image.blend(im, Image.effect_noise((width, height), 40).convert('RGB'), 0.5)
+        p = os.path.join(workdir, f"src_{i}.jpg")
+        im.save(p, format='JPEG', quality=90)
+        paths.append(p)
+    return paths
+
+
+def peak_rss_kb() -> int:
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1])
+    raise RuntimeError("VmHWM not in /proc/self/status")
+
+
+def run_variant(variant: str, paths: List[str], rounds: int) -> dict:
+    sys.path.insert(0, ROOT)
+    from collage import create_collage_image
+
+    fn = legacy_collage if variant == 'legacy' else create_collage_image
+    out = os.path.join(os.path.dirname(paths[0]), f"out_{variant}.jpg")
+    base_rss = peak_rss_kb()
+    times = []
+    for _ in range(rounds):
+        t0 = time.perf_counter()
+        fn(paths, out)
+        times.append(time.perf_counter() - t0)
+    peak_rss = peak_rss_kb()
+    return {
+        'variant': variant,
+        'rounds': rounds,
+        'wall_min_s': round(min(times), 4),
+        'wall_avg_s': round(sum(times) / len(times), 4),
+        'peak_rss_kb': peak_rss,
+        'peak_rss_delta_kb': peak_rss - base_rss,
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument('--images', type=int, default=4)
+    ap.add_argument('--width', type=int, default=3024)
+    ap.add_argument('--height', type=int, default=4032)
+    ap.add_argument('--rounds', type=int, default=5)
+    ap.add_argument('--variant', choices=['legacy', 'draft'], help=argparse.SUPPRESS)
+    ap.add_argument('--paths', nargs='*', help=argparse.SUPPRESS)
+    args = ap.parse_args()
+
+    if args.variant:
+        print(json.dumps(run_variant(args.variant, args.paths, args.rounds)))
+        return
+
+    with tempfile.TemporaryDirectory(prefix="bench_collage_") as workdir:
+        paths = make_images(workdir, args.images, args.width, args.height)
+        results = []
+        for variant in ('legacy', 'draft'):
+            proc = subprocess.run(
+                [sys.executable, __file__, '--variant', variant, '--rounds', str(args.rounds), '--paths', *paths],
+                check=True, capture_output=True, text=True)
+            results.append(json.loads(proc.stdout.strip().splitlines()[-1]))
+
+    print(f"{args.images} x {args.width}x{args.height} JPEG, {args.rounds} rounds")
+    for r in results:
+        print(f"  {r['variant']:>6}: min {r['wall_min_s'] * 1000:8.1f} ms  avg {r['wall_avg_s'] * 1000:8.1f} ms  "
+              f"peak RSS {r['peak_rss_kb'] / 1024:7.1f} MB (+{r['peak_rss_delta_kb'] / 1024:.1f} over import)")
+
+
+if __name__ == '__main__':
+    main()
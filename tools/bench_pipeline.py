@@ -0,0 +1,450 @@
+"""
+End-to-end pipeline benchmark with fake Instagram and fake Telegram backends.
+
+Nothing touches the network. The parent process runs:
+- a fake Instagram CDN that serves synthetic JPEGs and video bytes
+- tools/fake_botapi.py with injectable per-call latency
+Each workload then runs in a fresh subprocess, so its peak RSS is its own
+(VmHWM, which restarts at exec; ru_maxrss would carry over the parent's
+peak, e.g. from serving the large video).
+The subprocess imports bot.py and stubs instaloader.Post.from_shortcode
+with synthetic posts whose media URLs point at the fake CDN. It then calls
+handle_instagram directly, just as an incoming message would (or
+ahandle_instagram on an event loop with --engine async). bot.py
+streams media from the CDN URLs itself, so Instaloader.download_post is
+never used and the fake CDN is its stand-in.
+
+Workloads:
+  single       1 link, 1 photo
+  batch10      10 links of 1 photo each, in one message
+  carousel     1 link, --carousel photos (collage + album)
+  large_video  1 link, 1 video of --video-mb (spills to TEMP_DIR)
+
+Each workload reports throughput (messages/links/MB per second),
+p50/p95/p99 message latency, peak RSS and the bot's own per-stage
+histograms. The results go to a JSON file. --compare prints the
+per-metric change against an earlier results file.
+
+Run:
+    python tools/bench_pipeline.py [--workloads single batch10 carousel large_video]
+        [--api-latency 0.05] [--cdn-latency 0.02] [--concurrency 1] [--engine threads|async]
+        [--passthrough]
+        [--out bench_results.json] [--compare baseline.json]
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List
+
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fake_botapi import FakeBotAPI  # noqa: E402
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+WORKLOADS = {
+    # name: (links per message, photos per link, videos per link, default iterations)
+    'single': (1, 1, 0, 20),
+    'batch10': (10, 1, 0, 5),
+    'carousel': (1, None, 0, 10),
+    'large_video': (1, 0, 1, 3),
+}
+
+
+# -------------------- fake Instagram CDN --------------------
+
+class FakeCDN:
+    """Stateless media server.
+
+    GET /photo/<w>x<h>/<name>.jpg  -> a JPEG of that size (encoded once, then cached)
+    GET /video/<bytes>/<name>.mp4  -> that many bytes, streamed from a 1 MB block
+    HEAD answers with the same Content-Length (passthrough mode sizes files that way)
+    """
+
+    BLOCK = os.urandom(1024 * 1024)
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.jpegs: Dict[str, bytes] = {}
+        self.lock = threading.Lock()
+        cdn = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                cdn._handle(self)
+
+            def do_HEAD(self):
+                cdn._handle(self, body=False)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    def _jpeg(self, dims: str) -> bytes:
+        with self.lock:
+            data = self.jpegs.get(dims)
+            if data is None:
+                w, h = (int(x) for x in dims.split('x'))
+                # gradient + noise compresses like a real photo rather than a flat fill
+                im = Image.linear_gradient('L').resize((w, h)).convert('RGB')
+                im = Image.blend(im, Image.effect_noise((w, h), 40).convert('RGB'), 0.5)
+                out = io.BytesIO()
+                im.save(out, format='JPEG', quality=90)
+                data = self.jpegs[dims] = out.getvalue()
+            return data
+
+    def _handle(self, req: BaseHTTPRequestHandler, body: bool = True):
+        if self.latency:
+            time.sleep(self.latency)
+        parts = req.path.strip('/').split('/')
+        try:
+            kind, arg = parts[0], parts[1]
+            if kind == 'photo':
+                data = self._jpeg(arg)
+                req.send_response(200)
+                req.send_header('Content-Type', 'image/jpeg')
+                req.send_header('Content-Length', str(len(data)))
+                req.end_headers()
+                if body:
+                    req.wfile.write(data)
+                return
+            if kind == 'video':
+                remaining = int(arg)
+                req.send_response(200)
+                req.send_header('Content-Type', 'video/mp4')
+                req.send_header('Content-Length', str(remaining))
+                req.end_headers()
+                while body and remaining > 0:
+                    chunk = self.BLOCK[:remaining]
+                    req.wfile.write(chunk)
+                    remaining -= len(chunk)
+                return
+        except (IndexError, ValueError):
+            pass
+        req.send_response(404)
+        req.send_header('Content-Length', '0')
+        req.end_headers()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+# -------------------- synthetic posts --------------------
+
+class FakeNode:
+    def __init__(self, kind: str, url: str):
+        self.is_video = kind == 'video'
+        self.video_url = url if self.is_video else None
+        self.display_url = url
+
+
+class FakePost:
+    """Just the attributes bot.py reads from instaloader.Post."""
+
+    def __init__(self, shortcode: str, nodes: List[FakeNode]):
+        self.shortcode = shortcode
+        self.nodes = nodes
+        self.typename = 'GraphSidecar' if len(nodes) > 1 else ('GraphVideo' if nodes[0].is_video else 'GraphImage')
+        self.is_video = nodes[0].is_video
+        self.video_url = nodes[0].video_url
+        self.url = nodes[0].display_url
+        self.mediacount = len(nodes)
+        self.owner_username = 'bench_user'
+        self.caption = f"Synthetic post {shortcode} #bench #pipeline"
+        self.date_utc = datetime(2024, 1, 1)
+
+    def get_sidecar_nodes(self):
+        return iter(self.nodes)
+
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    idx = min(len(sorted_values) - 1, max(0, int(round(q * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[idx]
+
+
+# -------------------- workload runner (subprocess) --------------------
+
+def peak_rss_kb() -> int:
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1])
+    raise RuntimeError("VmHWM not in /proc/self/status")
+
+
+def run_workload(name: str, args: argparse.Namespace) -> Dict[str, Any]:
+    data_dir = tempfile.mkdtemp(prefix='bench_data_')
+    os.environ.update({
+        'BOT_TOKEN': '0:bench',
+        'TELEGRAM_API_URL': args.api_url,
+        'DATA_DIR': data_dir,
+        'TEMP_DIR': data_dir,
+        'RATE_LIMIT_PER_MIN': '1000000',
+        'CHANNEL_USERNAME': '', 'CHANNEL_ID': '', 'IG_USER': '', 'IG_PASS': '',
+    })
+    sys.path.insert(0, ROOT)
+    import asyncio
+    import instaloader
+    import telebot
+    import bot
+
+    if args.passthrough:
+        for c in range(args.concurrency):
+            bot.PREFS.set(1000 + c, {'mode': 'media', 'caption_on': True, 'passthrough': True})
+
+    links, photos, videos, default_iters = WORKLOADS[name]
+    if photos is None:
+        photos = args.carousel
+    iterations = args.iterations or default_iters
+    photo_path = f"{args.cdn_url}/photo/{args.photo_size}x{args.photo_size}"
+    video_path = f"{args.cdn_url}/video/{int(args.video_mb * 1024 * 1024)}"
+
+    posts: Dict[str, FakePost] = {}
+    lock = threading.Lock()
+
+    def make_post(shortcode: str) -> FakePost:
+        nodes = [FakeNode('photo', f"{photo_path}/{shortcode}_{i}.jpg") for i in range(photos)]
+        nodes += [FakeNode('video', f"{video_path}/{shortcode}_v{i}.mp4") for i in range(videos)]
+        return FakePost(shortcode, nodes)
+
+    def from_shortcode(cls, context, shortcode):
+        with lock:
+            return posts[shortcode]
+
+    instaloader.Post.from_shortcode = classmethod(from_shortcode)
+
+    def message(msg_id: int, chat_id: int, text: str):
+        return telebot.types.Message.de_json({
+            'message_id': msg_id, 'date': int(time.time()), 'text': text,
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': 'Bench'},
+        })
+
+    # build every message up front; shortcodes are unique so the upload cache never hits
+    messages = []
+    for it in range(iterations):
+        for c in range(args.concurrency):
+            text = []
+            for k in range(links):
+                shortcode = f"B{name[:2]}{it:03d}{c:02d}{k:02d}"
+                posts[shortcode] = make_post(shortcode)
+                text.append(f"https://www.instagram.com/p/{shortcode}/")
+            messages.append((it, message(len(messages) + 1, 1000 + c, '\n'.join(text))))
+
+    latencies: List[float] = []
+
+    def one(m) -> float:
+        t0 = time.perf_counter()
+        bot.handle_instagram(m)
+        return time.perf_counter() - t0
+
+    async def aone(m) -> float:
+        t0 = time.perf_counter()
+        await bot.ahandle_instagram(m)
+        return time.perf_counter() - t0
+
+    async def arun():
+        await bot.astart()
+        try:
+            for it in range(iterations):
+                latencies.extend(await asyncio.gather(*(aone(m) for i, m in messages if i == it)))
+        finally:
+            await bot.astop()
+
+    base_rss = peak_rss_kb()
+    t_start = time.perf_counter()
+    if args.engine == 'async':
+        bot.setup_async()
+        asyncio.run(arun())
+    else:
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            for it in range(iterations):
+                batch = [m for i, m in messages if i == it]
+                latencies += list(pool.map(one, batch))
+    wall = time.perf_counter() - t_start
+    peak_rss = peak_rss_kb()
+
+    counters = dict(bot.METRICS.counters)
+    urls = {dict(labels).get('result'): int(v) for (n, labels), v in counters.items() if n == 'ig_urls_total'}
+    sent_bytes = int(counters.get(('ig_bytes_sent_total', ()), 0))
+    stages = {}
+    for stage, h in bot.METRICS.hist.items():
+        stages[stage] = {
+            'count': h['count'],
+            'mean_ms': round(h['sum'] / h['count'] * 1000, 2) if h['count'] else 0.0,
+            'p50_ms': round((bot.METRICS.quantile(stage, 0.5) or 0) * 1000, 2),
+            'p95_ms': round((bot.METRICS.quantile(stage, 0.95) or 0) * 1000, 2),
+        }
+    lat = sorted(latencies)
+    return {
+        'workload': name,
+        'engine': args.engine,
+        'iterations': iterations,
+        'concurrency': args.concurrency,
+        'messages': len(messages),
+        'links': len(messages) * links,
+        'links_failed': urls.get('failed', 0),
+        'items_sent': int(counters.get(('ig_items_sent_total', ()), 0)),
+        'bytes_sent': sent_bytes,
+        'bytes_saved': int(counters.get(('ig_bytes_saved_total', ()), 0)),
+        'wall_s': round(wall, 4),
+        'messages_per_s': round(len(messages) / wall, 3),
+        'links_per_s': round(len(messages) * links / wall, 3),
+        'mb_per_s': round(sent_bytes / (1024 * 1024) / wall, 3),
+        'latency_ms': {
+            'p50': round(percentile(lat, 0.50) * 1000, 2),
+            'p95': round(percentile(lat, 0.95) * 1000, 2),
+            'p99': round(percentile(lat, 0.99) * 1000, 2),
+            'mean': round(sum(lat) / len(lat) * 1000, 2),
+            'max': round(lat[-1] * 1000, 2),
+        },
+        'peak_rss_kb': peak_rss,
+        'peak_rss_delta_kb': peak_rss - base_rss,
+        'stages': stages,
+    }
+
+
+# -------------------- driver --------------------
+
+# metrics where a larger value is an improvement; everything else is lower-is-better
+HIGHER_IS_BETTER = {'messages_per_s', 'links_per_s', 'mb_per_s'}
+COMPARED = ['messages_per_s', 'links_per_s', 'mb_per_s', 'latency_ms.p50', 'latency_ms.p95',
+            'latency_ms.p99', 'peak_rss_kb']
+
+
+def _get(result: Dict[str, Any], path: str):
+    for part in path.split('.'):
+        result = result.get(part, {}) if isinstance(result, dict) else {}
+    return result if isinstance(result, (int, float)) else None
+
+
+def compare(baseline: Dict[str, Any], current: Dict[str, Any]):
+    print(f"\nvs {baseline['meta'].get('git_rev') or 'baseline'} ({baseline['meta'].get('timestamp')})")
+    for name, cur in current['workloads'].items():
+        old = baseline['workloads'].get(name)
+        if not old:
+            continue
+        print(f"  {name}")
+        for metric in COMPARED:
+            a, b = _get(old, metric), _get(cur, metric)
+            if a is None or b is None or not a:
+                continue
+            change = (b - a) / a * 100
+            better = change > 0 if metric.split('.')[-1] in HIGHER_IS_BETTER else change < 0
+            mark = '' if abs(change) < 5 else (' better' if better else ' WORSE')
+            print(f"    {metric:<16} {a:>12.2f} -> {b:>12.2f}  {change:+7.1f}%{mark}")
+
+
+def git_rev() -> str | None:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, check=True,
+                              capture_output=True, text=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument('--workloads', nargs='+', choices=list(WORKLOADS), default=list(WORKLOADS))
+    ap.add_argument('--iterations', type=int, default=0, help='override per-workload default')
+    ap.add_argument('--concurrency', type=int, default=1, help='chats sending at the same time')
+    ap.add_argument('--engine', choices=['threads', 'async'], default='threads', help='bot engine to drive')
+    ap.add_argument('--passthrough', action='store_true', help='chats use URL passthrough delivery')
+    ap.add_argument('--api-latency', type=float, default=0.05, help='seconds per fake Bot API call')
+    ap.add_argument('--cdn-latency', type=float, default=0.02, help='seconds before each CDN response')
+    ap.add_argument('--photo-size', type=int, default=1080, help='square photo edge in px')
+    ap.add_argument('--carousel', type=int, default=10, help='photos in the carousel workload')
+    ap.add_argument('--video-mb', type=float, default=50)
+    ap.add_argument('--out', default='bench_results.json')
+    ap.add_argument('--compare', help='earlier results file to diff against')
+    ap.add_argument('--worker', choices=list(WORKLOADS), help=argparse.SUPPRESS)
+    ap.add_argument('--api-url', help=argparse.SUPPRESS)
+    ap.add_argument('--cdn-url', help=argparse.SUPPRESS)
+    args = ap.parse_args()
+
+    if args.worker:
+        print(json.dumps(run_workload(args.worker, args)))
+        return
+
+    api = FakeBotAPI(latency=args.api_latency).start()
+    cdn = FakeCDN(latency=args.cdn_latency)
+    results: Dict[str, Any] = {}
+    try:
+        for name in args.workloads:
+            cmd = [sys.executable, os.path.abspath(__file__), '--worker', name,
+                   '--api-url', api.api_url, '--cdn-url', cdn.base_url,
+                   '--iterations', str(args.iterations), '--concurrency', str(args.concurrency),
+                   '--photo-size', str(args.photo_size), '--carousel', str(args.carousel),
+                   '--video-mb', str(args.video_mb), '--engine', args.engine]
+            if args.passthrough:
+                cmd.append('--passthrough')
+            api.reset()
+            proc = subprocess.run(cmd, capture_output=True, text=True)
+            if proc.returncode != 0:
+                sys.exit(f"workload {name} failed:\n{proc.stderr}")
+            r = json.loads(proc.stdout.strip().splitlines()[-1])
+            with api.lock:
+                calls: Dict[str, int] = {}
+                for c in api.calls:
+                    calls[c['method']] = calls.get(c['method'], 0) + 1
+            r['api_calls'] = calls
+            results[name] = r
+            lat = r['latency_ms']
+            print(f"{name:>12}: {r['messages']:>3} msg / {r['links']:>3} links in {r['wall_s']:7.2f}s  "
+                  f"{r['links_per_s']:7.2f} links/s {r['mb_per_s']:7.2f} MB/s  "
+                  f"p50 {lat['p50']:8.1f} p95 {lat['p95']:8.1f} p99 {lat['p99']:8.1f} ms  "
+                  f"RSS {r['peak_rss_kb'] / 1024:6.1f} MB"
+                  + (f"  {r['bytes_saved'] / (1024 * 1024):.1f} MB passed through" if r['bytes_saved'] else '')
+                  + (f"  ({r['links_failed']} failed)" if r['links_failed'] else ''))
+    finally:
+        api.stop()
+        cdn.stop()
+
+    report = {
+        'meta': {
+            'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'git_rev': git_rev(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'params': {k: getattr(args, k) for k in ('engine', 'passthrough', 'iterations', 'concurrency',
+                                                     'api_latency', 'cdn_latency', 'photo_size', 'carousel',
+                                                     'video_mb')},
+        },
+        'workloads': results,
+    }
+    with open(args.out, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f"wrote {args.out}")
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            compare(json.load(f), report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,243 @@
+"""
+Local fake Telegram Bot API server for offline testing.
+
+Answers the Bot API methods bot.py uses with plausible results, records every
+call, and can add per-method latency. Point the bot at it with
+    TELEGRAM_API_URL=http://127.0.0.1:<port>/bot{0}/{1}
+
+Recorded calls are also served as JSON on GET /_calls (and cleared by
+POST /_reset) so tests can drive a bot running in another process.
+flood() makes the next calls of a method fail with 429 + retry_after, and
+reject_urls() makes sends of media by matching URL fail the way Telegram
+does when it cannot fetch one.
+
+Run standalone:
+    python tools/fake_botapi.py --port 8081 --latency 0.05
+"""
+
+import json
+import time
+import itertools
+import argparse
+import threading
+from typing import Any, Dict, List
+from email.parser import BytesParser
+from email.policy import default
+from urllib.parse import urlsplit, parse_qsl
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeBotAPI:
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, latency: float = 0.0,
+                 method_latency: Dict[str, float] = None):
+        self.latency = latency
+        self.method_latency = dict(method_latency or {})
+        self.calls: List[Dict[str, Any]] = []
+        self.floods: Dict[str, List[float]] = {}  # method -> pending 429 retry_after values
+        self.bad_urls: List[str] = []  # media URLs containing any of these are refused
+        self.lock = threading.Lock()
+        self._ids = itertools.count(1)
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                api._handle(self)
+
+            def do_POST(self):
+                api._handle(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    # ---- lifecycle ----
+
+    @property
+    def port(self) -> int:
+        return self.server.server_port
+
+    @property
+    def api_url(self) -> str:
+        """Value for TELEGRAM_API_URL / telebot.apihelper.API_URL."""
+        return f"http://127.0.0.1:{self.port}/bot{{0}}/{{1}}"
+
+    def start(self) -> "FakeBotAPI":
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def calls_for(self, method: str) -> List[Dict[str, Any]]:
+        with self.lock:
+            return [c for c in self.calls if c['method'] == method]
+
+    def reset(self):
+        with self.lock:
+            self.calls.clear()
+            self.floods.clear()
+            self.bad_urls.clear()
+
+    def flood(self, method: str, times: int = 1, retry_after: float = 1):
+        """Answer the next `times` calls of method with 429 Too Many Requests."""
+        with self.lock:
+            self.floods.setdefault(method, []).extend([retry_after] * times)
+
+    def reject_urls(self, *fragments: str):
+        """Refuse media sent by a URL containing any of fragments, like Telegram does for unfetchable URLs."""
+        with self.lock:
+            self.bad_urls.extend(fragments)
+
+    def _refused_url(self, method: str, params: Dict[str, str]) -> bool:
+        if method == 'sendMediaGroup':
+            try:
+                sources = [item.get('media', '') for item in json.loads(params.get('media', '[]'))]
+            except ValueError:
+                sources = []
+        else:
+            sources = [params.get(k, '') for k in ('photo', 'video', 'document')]
+        with self.lock:
+            return any(frag in src for src in sources for frag in self.bad_urls)
+
+    # ---- request handling ----
+
+    def _handle(self, req: BaseHTTPRequestHandler):
+        parts = urlsplit(req.path)
+        length = int(req.headers.get('Content-Length') or 0)
+        body = req.rfile.read(length) if length else b''
+
+        if parts.path == '/_calls':
+            with self.lock:
+                return self._send(req, 200, self.calls)
+        if parts.path == '/_reset':
+            self.reset()
+            return self._send(req, 200, True)
+
+        segs = parts.path.strip('/').split('/')
+        if len(segs) != 2 or not segs[0].startswith('bot'):
+            return self._send(req, 404, {'ok': False, 'error_code': 404, 'description': 'Not Found'})
+        method = segs[1]
+        params = dict(parse_qsl(parts.query))
+        ctype = req.headers.get('Content-Type', '')
+        if body and ctype.startswith('multipart/'):
+            params.update(self._form_fields(ctype, body))
+        elif body:
+            params.update(parse_qsl(body.decode('utf-8', 'replace')))
+
+        delay = self.method_latency.get(method, self.latency)
+        if delay:
+            time.sleep(delay)
+
+        with self.lock:
+            self.calls.append({'method': method, 'params': params, 'upload_bytes': len(body),
+                               'ts': time.time()})
+            pending = self.floods.get(method)
+            retry_after = pending.pop(0) if pending else None
+        if retry_after is not None:
+            return self._send(req, 429, {'ok': False, 'error_code': 429,
+                                         'description': f'Too Many Requests: retry after {retry_after}',
+                                         'parameters': {'retry_after': retry_after}})
+        if self._refused_url(method, params):
+            return self._send(req, 400, {'ok': False, 'error_code': 400,
+                                         'description': 'Bad Request: failed to get HTTP URL content'})
+        try:
+            result = self.result_for(method, params)
+        except Exception as e:
+            return self._send(req, 400, {'ok': False, 'error_code': 400, 'description': f'Bad Request: {e}'})
+        self._send(req, 200, {'ok': True, 'result': result})
+
+    @staticmethod
+    def _form_fields(ctype: str, body: bytes) -> Dict[str, str]:
+        """Non-file fields of a multipart body (aiohttp puts every parameter there)."""
+        msg = BytesParser(policy=default).parsebytes(f'Content-Type: {ctype}\r\n\r\n'.encode() + body)
+        return {part.get_param('name', header='content-disposition'): part.get_content()
+                for part in msg.iter_parts() if part.get_filename() is None}
+
+    def _send(self, req: BaseHTTPRequestHandler, code: int, payload: Any):
+        data = json.dumps(payload).encode('utf-8')
+        req.send_response(code)
+        req.send_header('Content-Type', 'application/json')
+        req.send_header('Content-Length', str(len(data)))
+        req.end_headers()
+        req.wfile.write(data)
+
+    # ---- fake results ----
+
+    def _message(self, params: Dict[str, str], **extra) -> Dict[str, Any]:
+        chat_id = params.get('chat_id', '0')
+        try:
+            chat_id = int(chat_id)
+        except ValueError:
+            pass
+        msg = {'message_id': next(self._ids), 'date': int(time.time()),
+               'chat': {'id': chat_id, 'type': 'private'}}
+        if 'text' in params:
+            msg['text'] = params['text']
+        if 'caption' in params:
+            msg['caption'] = params['caption']
+        msg.update(extra)
+        return msg
+
+    def _file(self, kind: str) -> Dict[str, Any]:
+        n = next(self._ids)
+        f = {'file_id': f'{kind}-{n}', 'file_unique_id': f'u{n}'}
+        if kind == 'photo':
+            return [dict(f, width=1080, height=1080)]
+        if kind == 'video':
+            return dict(f, width=720, height=1280, duration=10)
+        return f
+
+    def result_for(self, method: str, params: Dict[str, str]) -> Any:
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'Fake', 'username': 'fake_bot'}
+        if method == 'getUpdates':
+            time.sleep(min(float(params.get('timeout', 0) or 0), 1.0))
+            return []
+        if method in ('setWebhook', 'deleteWebhook', 'answerCallbackQuery'):
+            return True
+        if method == 'getChatMember':
+            return {'status': 'member', 'user': {'id': int(params.get('user_id', 0)), 'is_bot': False,
+                                                 'first_name': 'User'}}
+        if method in ('sendMessage', 'editMessageText', 'editMessageReplyMarkup'):
+            return self._message(params)
+        if method == 'sendPhoto':
+            return self._message(params, photo=self._file('photo'))
+        if method == 'sendVideo':
+            return self._message(params, video=self._file('video'))
+        if method == 'sendDocument':
+            return self._message(params, document=self._file('document'))
+        if method == 'sendMediaGroup':
+            out = []
+            for item in json.loads(params['media']):
+                kind = item['type']
+                p = dict(params)
+                p.pop('media', None)
+                if item.get('caption'):
+                    p['caption'] = item['caption']
+                out.append(self._message(p, **{kind: self._file(kind)}))
+            return out
+        raise ValueError(f'method {method} not faked')
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Fake Telegram Bot API server')
+    ap.add_argument('--host', default='127.0.0.1')
+    ap.add_argument('--port', type=int, default=8081)
+    ap.add_argument('--latency', type=float, default=0.0, help='seconds added to every call')
+    args = ap.parse_args()
+    api = FakeBotAPI(args.host, args.port, args.latency).start()
+    print(f'Fake Bot API on {api.api_url}')
+    try:
+        api.thread.join()
+    except KeyboardInterrupt:
+        api.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+"""
+End-to-end check of BOT_MODE=webhook against tools/fake_botapi.py.
+
+Starts the fake Bot API, launches bot.py as a subprocess in webhook mode,
+then POSTs a burst of command updates for several chats. Updates rejected
+with 503 (backpressure) are redelivered the way Telegram does. It checks:
+- the defaults (slow API, tiny queue) actually trigger backpressure
+- setWebhook was called with the configured URL and secret
+- an update with the wrong secret token is refused with 403
+- every update got its reply, and each chat's replies arrived in send order
+- SIGTERM drains the queue and the process exits cleanly
+
+Run:
+    python tools/webhook_e2e.py [--chats 5] [--per-chat 8] [--latency 0.2] [--queue-max 2]
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import signal
+import argparse
+import tempfile
+import subprocess
+import urllib.error
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fake_botapi import FakeBotAPI  # noqa: E402
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SECRET = 'e2e-secret'
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def command_update(update_id: int, chat_id: int, text: str) -> dict:
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': 'E2E'},
+            'text': text,
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}],
+        },
+    }
+
+
+def post(url: str, payload: dict, secret: str = SECRET) -> int:
+    req = urllib.request.Request(url, data=json.dumps(payload).encode(), method='POST', headers={
+        'Content-Type': 'application/json', 'X-Telegram-Bot-Api-Secret-Token': secret})
+    try:
+        with urllib.request.urlopen(req, timeout=10) as resp:
+            return resp.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def wait_until(pred, timeout: float, what: str):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if pred():
+            return
+        time.sleep(0.05)
+    raise SystemExit(f"FAIL: timed out waiting for {what}")
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Webhook mode end-to-end check')
+    ap.add_argument('--chats', type=int, default=5)
+    ap.add_argument('--per-chat', type=int, default=8)
+    ap.add_argument('--latency', type=float, default=0.2, help='fake Bot API latency per call')
+    ap.add_argument('--queue-max', type=int, default=2, help='small to exercise backpressure')
+    args = ap.parse_args()
+
+    api = FakeBotAPI(latency=args.latency).start()
+    port = free_port()
+    env = dict(os.environ,
+               BOT_TOKEN='123:e2e', BOT_MODE='webhook', TELEGRAM_API_URL=api.api_url,
+               DATA_DIR=tempfile.mkdtemp(prefix='e2e_data_'),
+               WEBHOOK_URL=f'http://127.0.0.1:{port}', WEBHOOK_PORT=str(port), WEBHOOK_LISTEN='127.0.0.1',
+               WEBHOOK_SECRET=SECRET, WEBHOOK_WORKERS='3', WEBHOOK_QUEUE_MAX=str(args.queue_max),
+               WEBHOOK_ENQUEUE_TIMEOUT='0.2', CHANNEL_USERNAME='', CHANNEL_ID='', IG_USER='', IG_PASS='')
+    proc = subprocess.Popen([sys.executable, os.path.join(ROOT, 'bot.py')], env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    try:
+        wait_until(lambda: api.calls_for('setWebhook'), 20, 'setWebhook')
+        hook = api.calls_for('setWebhook')[0]['params']
+        assert hook['url'] == f'http://127.0.0.1:{port}/telegram', hook
+        assert hook['secret_token'] == SECRET, hook
+
+        url = f'http://127.0.0.1:{port}/telegram'
+        code = post(url, command_update(10 ** 6, 1000, '/start'), secret='forged')
+        if code != 403:
+            raise SystemExit(f"FAIL: update with a wrong secret got {code}, want 403")
+        expected = {}
+        pending = []
+        uid = 0
+        for i in range(args.per_chat):
+            for c in range(args.chats):
+                chat_id = 1000 + c
+                choice = 'document' if i % 2 == 0 else 'media'
+                uid += 1
+                pending.append(command_update(uid, chat_id, f'/mode {choice}'))
+                expected.setdefault(chat_id, []).append(choice)
+
+        # deliver like Telegram: per chat in order, retry 503s
+        rejected = 0
+        t0 = time.time()
+        while pending:
+            retry = []
+            blocked = set()
+            for upd in pending:
+                chat_id = upd['message']['chat']['id']
+                if chat_id in blocked:
+                    retry.append(upd)
+                    continue
+                code = post(url, upd)
+                if code == 503:
+                    rejected += 1
+                    blocked.add(chat_id)
+                    retry.append(upd)
+                elif code != 200:
+                    raise SystemExit(f"FAIL: webhook returned {code}")
+            pending = retry
+            if pending:
+                time.sleep(0.1)
+        accept_s = time.time() - t0
+        if rejected == 0:
+            raise SystemExit("FAIL: no update was rejected with 503; backpressure was not exercised "
+                             "(raise --latency or lower --queue-max)")
+
+        total = args.chats * args.per_chat
+        wait_until(lambda: len(api.calls_for('sendMessage')) >= total, 60, f'{total} replies')
+
+        for chat_id, choices in expected.items():
+            got = [c['params']['text'] for c in api.calls_for('sendMessage')
+                   if int(c['params']['chat_id']) == chat_id]
+            want = [f"✅ Mode updated to <b>{x}</b>" for x in choices]
+            if got != want:
+                raise SystemExit(f"FAIL: chat {chat_id} replies out of order:\n{got}\n!=\n{want}")
+
+        proc.send_signal(signal.SIGTERM)
+        out, _ = proc.communicate(timeout=30)
+        if proc.returncode != 0 or 'Stopped' not in out:
+            raise SystemExit(f"FAIL: unclean shutdown (rc={proc.returncode}):\n{out}")
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+        api.stop()
+
+    print(f"OK: {total} updates across {args.chats} chats, per-chat order kept, "
+          f"{rejected} backpressure 503s retried, accepted in {accept_s:.2f}s, clean drain")
+
+
+if __name__ == '__main__':
+    main()